@@ -57,6 +57,16 @@ export function getStoredApiUrl(): string {
   return getApiBaseUrl() || DEFAULT_API_URL
 }
 
+/**
+ * 本瀏覽器送出的處理任務 ID：偵測結果改從 /api/jobs/{job_id} 取得，
+ * 避免多位使用者共用伺服器時讀到別人的結果
+ */
+let _activeJobId: string | null = null
+
+export function setActiveJobId(jobId: string | null): void {
+  _activeJobId = jobId
+}
+
 /**
  * 強制完整 mock 模式（用於 /mock 路由）
  */
@@ -163,7 +173,16 @@ async function fetchDetections(projectId: string): Promise<DetectionObject[]> {
     return MOCK_OBJECTS
   }
 
-  // 呼叫真實 API
+  // 呼叫真實 API：有自己的任務時讀取該任務的結果
+  if (_activeJobId) {
+    try {
+      const job = await apiRequest<{ results: DetectionObject[] | null }>(`/api/jobs/${_activeJobId}`)
+      return job.results ?? []
+    } catch {
+      // 任務紀錄已清除（伺服器重啟或清除資料），改用最近完成的結果
+      _activeJobId = null
+    }
+  }
   return apiRequest<DetectionObject[]>(`/api/detections/${projectId}`)
 }
 
@@ -331,10 +350,21 @@ export function getLandcoverOverlayUrl(alpha = 0.5, maxWidth = 2000, quality = 8
 }
 
 /**
- * 執行土地覆蓋分析
+ * 執行土地覆蓋分析（後端於背景執行，輪詢狀態直到完成）
  */
-async function runLandcoverAnalysis(): Promise<{ status: string; stats: Record<string, unknown> }> {
-  return apiRequest('/api/landcover/run', { method: 'POST' })
+async function runLandcoverAnalysis(): Promise<LandcoverStatus> {
+  await apiRequest('/api/landcover/run', { method: 'POST' })
+
+  for (;;) {
+    await new Promise((resolve) => setTimeout(resolve, 1000))
+    const status = await apiRequest<LandcoverStatus>('/api/landcover/status')
+    if (status.job?.status === 'error' || status.job?.status === 'cancelled') {
+      throw new Error(status.job.error || `Landcover analysis ${status.job.status}`)
+    }
+    if (status.job?.status !== 'pending' && status.job?.status !== 'running') {
+      return status
+    }
+  }
 }
 
 // ============================================
@@ -434,10 +464,12 @@ export interface ProcessingResponse {
  */
 export interface ProcessingStatusResponse {
   job_id: string
-  status: 'pending' | 'running' | 'done' | 'error'
+  status: 'pending' | 'running' | 'done' | 'error' | 'cancelled'
   progress: number
   current_step: string
   elapsed_seconds: number
+  queue_position?: number
+  wait_seconds?: number
 }
 
 /**
@@ -611,6 +643,7 @@ export function useStartProcessing() {
   return useMutation({
     mutationFn: startProcessing,
     onSuccess: (data) => {
+      setActiveJobId(data.job_id)
       notify.info('Processing started', `Job ID: ${data.job_id}`)
     },
     onError: (error) => {
@@ -628,9 +661,9 @@ export function useProcessingStatus(jobId: string | null) {
     queryFn: () => fetchProcessingStatus(jobId!),
     enabled: !!jobId, // 只有當 jobId 存在時才執行
     refetchInterval: (query) => {
-      // 任務完成後停止輪詢
+      // 任務結束後停止輪詢
       const status = query.state.data?.status
-      if (status === 'done' || status === 'error') {
+      if (status === 'done' || status === 'error' || status === 'cancelled') {
         return false
       }
       return 1000 // 每秒更新一次
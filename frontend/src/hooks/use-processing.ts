@@ -4,7 +4,7 @@ import * as React from 'react'
 import { useQueryClient } from '@tanstack/react-query'
 import type { ProcessingStep } from '@/types/detection'
 import { INITIAL_PROCESSING_STEPS } from '@/api/mock-data'
-import { getStoredApiUrl, orthoKeys } from '@/api/queries'
+import { getStoredApiUrl, orthoKeys, setActiveJobId } from '@/api/queries'
 
 interface UseProcessingReturn {
   isRunning: boolean
@@ -26,6 +26,7 @@ export function useProcessing(): UseProcessingReturn {
     INITIAL_PROCESSING_STEPS
   )
   const pollingRef = React.useRef<NodeJS.Timeout | null>(null)
+  const jobIdRef = React.useRef<string | null>(null)
   const startTimeRef = React.useRef<number>(0)
 
   const pollStatus = React.useCallback(async () => {
@@ -33,7 +34,9 @@ export function useProcessing(): UseProcessingReturn {
     if (!apiUrl) return
 
     try {
-      const response = await fetch(`${apiUrl}/api/process/status`)
+      // 輪詢自己送出的工作，避免其他使用者的工作覆蓋進度
+      const statusPath = jobIdRef.current ? `/api/process/${jobIdRef.current}/status` : '/api/process/status'
+      const response = await fetch(`${apiUrl}${statusPath}`)
       const data = await response.json()
 
       setProgress(data.progress || 0)
@@ -65,7 +68,7 @@ export function useProcessing(): UseProcessingReturn {
           clearInterval(pollingRef.current)
           pollingRef.current = null
         }
-      } else if (data.status === 'error') {
+      } else if (data.status === 'error' || data.status === 'cancelled') {
         setIsRunning(false)
         setSteps((prev) =>
           prev.map((s, i) =>
@@ -162,6 +165,9 @@ export function useProcessing(): UseProcessingReturn {
         return
       }
 
+      jobIdRef.current = data.job_id ?? null
+      // 偵測結果改讀取自己的任務 (/api/jobs/{job_id})
+      setActiveJobId(jobIdRef.current)
       console.log('✅ Started polling status...')
       // 開始輪詢狀態
       pollingRef.current = setInterval(pollStatus, 1000)
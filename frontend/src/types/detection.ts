@@ -99,9 +99,19 @@ export interface LandcoverStats {
   stats: Record<string, LandcoverClassStats>
 }
 
+export interface LandcoverJob {
+  status: 'idle' | 'pending' | 'running' | 'done' | 'error' | 'cancelled'
+  job_id?: string
+  progress: number
+  current_step: string
+  elapsed_seconds: number
+  error: string | null
+}
+
 export interface LandcoverStatus {
   computed: boolean
   has_stats: boolean
+  job?: LandcoverJob
 }
 
 // Terrain types
@@ -8,10 +8,12 @@ import os
 import shutil
 import io
 from pathlib import Path
+from collections import OrderedDict
+from itertools import count
 from datetime import datetime
 
 import numpy as np
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, FileResponse, Response
 from pydantic import BaseModel
@@ -34,6 +36,17 @@ app.add_middleware(
 UPLOAD_DIR = Path("/tmp/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+LANDCOVER_DIR = Path("/tmp/landcover")
+LANDCOVER_DIR.mkdir(parents=True, exist_ok=True)
+
+TERRAIN_DIR = Path("/tmp/terrain")
+TERRAIN_DIR.mkdir(parents=True, exist_ok=True)
+
+# 點雲欄位式快取 (memmap)，HF Space 開啟持久儲存時放在 /data 以跨重啟沿用
+POINTCLOUD_STORE_DIR = Path(os.environ.get(
+    "POINTCLOUD_STORE_DIR", "/data/pointcloud_store" if os.path.isdir("/data") else "/tmp/pointcloud_store"))
+POINTCLOUD_STORE_DIR.mkdir(parents=True, exist_ok=True)
+
 MODEL_DIR = Path("/tmp/models")
 MODEL_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -87,6 +100,104 @@ MODELS_CONFIG = {
     },
 }
 
+# 批次推論：一次送入多個 patch，batch_size = 0 時依可用記憶體自動決定
+YOLO_BATCH_CONFIG = {
+    "batch_size": 0,
+    "max_batch_size": 16,
+    "memory_fraction": 0.25,  # 自動模式最多使用可用記憶體的比例
+    "bytes_per_pixel": 160,  # 每個輸入像素推論時的記憶體估計 (輸入 + 特徵圖)
+}
+
+# 背景預讀：讀取執行緒各自開啟 rasterio dataset (GDAL handle 不可跨執行緒共用)
+PREFETCH_CONFIG = {
+    "depth": 8,  # 預先準備好的 patch 數上限
+    "workers": 2,
+}
+
+# 多行程平行推論 (CPU)：每個 worker 各自載入模型與開啟 rasterio dataset
+PARALLEL_CONFIG = {
+    "workers": 0,  # 0 = 關閉，-1 = 使用全部 CPU 核心
+    "chunk_tiles": 16,  # YOLO 每個工作單位的切片數
+    "chunk_rows": 4,  # UPerNet 每個工作單位的切片列數
+}
+
+# 空白切片預篩：以 dataset mask / nodata 或低解析度讀取判斷切片是否有資料
+NODATA_CONFIG = {
+    "skip_empty": True,
+    "max_mask_size": 2048,  # 低解析度有效像素遮罩的最大邊長
+    "dark_threshold": 10,  # 無 mask 時，三個 band 都 <= 此值視為 nodata (同土地覆蓋)
+}
+
+# 切片規劃：adaptive 依各類別最大物件尺寸計算最小安全重疊，dense 沿用 MODELS_CONFIG 的 overlap
+TILING_CONFIG = {
+    "mode": "adaptive",
+    "safety_factor": 1.5,  # 重疊 = 最大物件邊長 (像素) x 安全係數
+    "min_overlap": 32,
+    "seconds_per_tile": {"cpu": 0.8, "cuda": 0.05},  # 單一模型推論一個 1024 patch 的時間估計
+}
+
+# 地形分析逐區塊處理：每塊連同 1 像素 halo 讀取，坡度/坡向寫入 TERRAIN_DIR 的分塊 GeoTIFF
+TERRAIN_CONFIG = {
+    "block_size": 2048,
+    "histogram_bins": 90,  # 坡度直方圖 0-90 度
+}
+
+# 上傳後於背景轉為 Cloud-Optimized GeoTIFF (分塊 + 壓縮 + overview)，完成後替換開啟中的檔案
+COG_CONFIG = {
+    "enabled": True,
+    "blocksize": 512,
+    "compress": "DEFLATE",
+    "overview_resampling": "AVERAGE",
+}
+
+# 上傳以非同步分塊寫入磁碟並同時計算 SHA-256，解析/載入交給單一背景匯入執行緒依序處理
+UPLOAD_CONFIG = {
+    "chunk_size": 8 * 1024 ** 2,
+}
+
+# 背景工作 (偵測處理、土地覆蓋)：固定數量 worker 依優先權與送出順序執行，各工作獨立保存狀態與結果
+JOB_CONFIG = {
+    "workers": 1,  # 同時執行的工作數 (模型推論共用 CPU/GPU，預設一次一個)
+    "max_queue": 16,  # 排隊中工作數上限，超過時回 503
+    "max_history": 50,  # 保留的已結束工作數
+}
+
+# 計算/編碼工作移出事件迴圈：共用有界執行緒池，各端點群組另有同時執行上限與排隊上限
+COMPUTE_CONFIG = {
+    "workers": min(8, os.cpu_count() or 4),
+    "limits": {"image": 2, "tiles": 4, "terrain": 1},  # 各群組同時執行數，其餘依到達順序排隊
+    "max_waiting": 64,  # 單一群組排隊數上限，超過時回 503
+}
+
+# 非 uint8 正射影像的輻射統計：匯入時由 overview / 降採樣讀取計算直方圖與百分位拉伸，之後以 LUT 轉換
+ORTHO_STATS_CONFIG = {
+    "sample_size": 2048,  # 統計用降採樣影像的最大邊長
+    "low_percentile": 0.5,
+    "high_percentile": 99.5,
+    "histogram_bins": 256,
+}
+
+# 已編碼圖片回應快取 (LRU)，以資料版本 + 參數為鍵，支援 ETag / If-None-Match
+RESPONSE_CACHE_CONFIG = {
+    "max_bytes": 256 * 1024 ** 2,
+    "max_entries": 1024,
+}
+
+# 點雲均勻網格索引：依平均密度自動決定格網大小，使每格約 points_per_cell 個點
+POINT_INDEX_CONFIG = {
+    "cell_size": None,  # 公尺，None = 自動
+    "points_per_cell": 256,
+    "min_cell": 0.25,
+    "max_cells": 50_000_000,
+}
+
+# 點雲串流載入：分塊解壓，只保留正射影像範圍 (加邊界) 內的點
+POINTCLOUD_CONFIG = {
+    "chunk_size": 2_000_000,
+    "crop_margin": 10.0,  # 公尺
+    "store_budget_gb": 20.0,  # 點雲快取磁碟上限，超過時依最近使用時間淘汰
+}
+
 HEIGHT_RANGE = {
     "person": (1.45, 1.90),
     "cone": (0.25, 0.90),
@@ -118,8 +229,15 @@ LANDCOVER_COLORS = {
 UPERNET_CONFIG = {
     "filename": "UPerNet_best.pth",
     "num_classes": 6,
-    "tile_size": (64, 64),
+    "tile_size": (64, 64),  # 模型訓練時的輸入大小；需為 32 的倍數 (ResNet50 encoder output stride)
     "overlap": 0.5,
+    "batch_size": 8,
+    # 重疊區融合方式：uniform (平均) 或 gaussian (切片中心權重較高)。
+    # 較大切片 (如 256 / 0.25 overlap + gaussian) 可減少推論次數，但金字塔池化隨輸入大小改變，需自行驗證精度
+    "blend": "uniform",
+    "gaussian_sigma": 0.25,  # 高斯標準差 (相對切片邊長)
+    "target_gsd": None,  # 土地覆蓋推論解析度 (公尺)，None = 使用正射影像原始解析度
+    "block_memory_mb": 512,  # 逐列區塊處理時每個區塊 logits 累加陣列的記憶體上限
     "encoder_name": "resnet50",
 }
 
@@ -137,30 +255,54 @@ HEIGHT_PRIOR = {
 CELL_BY_CLASS = {"person": 0.05, "cone": 0.05, "car": 0.10}
 MIN_PTS_BY_CLASS = {"person": 8, "cone": 10, "car": 30}
 
+# 點雲高度格網：每次載入點雲時依 CELL_BY_CLASS 解析度分箱一次
+HEIGHT_GRID_CONFIG = {
+    "ground_cell": 0.5,  # 地面高 (DTM) 格網大小 (公尺)
+    "ground_window": 6.0,  # 地面高取局部最小值的視窗 (公尺)，需大於最大物件寬度
+    "low_percentile": 5,
+    "top_percentile": 95,
+    "max_cells": 20_000_000,  # 單一格網的格數上限 (每格約 20 bytes，建立時峰值約 30 bytes)，超過時改用放得下的較粗解析度
+    "ndsm_max": 10.0,  # nDSM 彩色圖的最大高度 (公尺)
+}
+
 rng = np.random.default_rng(42)
 
 # ============================================
 # 全域狀態
 # ============================================
 uploaded_files = {"ortho": None, "laz": None, "dsm": None, "ortho_ref": None, "dsm_ref": None}
-ortho_cache = {"src": None, "transform": None, "crs": None, "bounds": None, "width": 0, "height": 0, "pixel_w": 0, "pixel_h": 0}
-pointcloud_cache = {"X": None, "Y": None, "Z": None, "loaded": False}
-dsm_cache = {"data": None, "transform": None, "crs": None, "loaded": False, "nodata": None}
+ortho_cache = {"src": None, "transform": None, "crs": None, "bounds": None, "width": 0, "height": 0, "pixel_w": 0, "pixel_h": 0, "valid_mask": None, "radiometry": None, "stretch_lut": None}
+pointcloud_cache = {"X": None, "Y": None, "Z": None, "index": None, "origin": None, "stats": None, "grids": None, "ground": None, "loaded": False}
+dsm_cache = {"src": None, "path": None, "transform": None, "crs": None, "loaded": False, "nodata": None, "terrain": None}
 # 參考期資料（用於變化偵測）
 ref_ortho_cache = {"data": None, "transform": None, "loaded": False}
 ref_dsm_cache = {"data": None, "transform": None, "loaded": False}
 change_detection_cache = {"result": None, "computed": False}
 models_cache = {"loaded": False, "models": {}}
 upernet_cache = {"loaded": False, "model": None}
-landcover_cache = {"mask": None, "stats": None, "computed": False}
-processing_state = {"job_id": None, "status": "idle", "progress": 0, "current_step": "", "elapsed_seconds": 0, "results": [], "start_time": None}
-
+landcover_cache = {"mask": None, "mask_path": None, "stats": None, "computed": False, "skipped_tiles": 0, "resolution": None}
+prefetch_stats = {}
+cog_state = {"ortho": {"status": "idle"}, "dsm": {"status": "idle"}}
+data_versions = {"ortho": 0, "dsm": 0, "landcover": 0, "pointcloud": 0}  # 資料內容版本，變更時使圖片快取失效
+response_cache = {"entries": OrderedDict(), "bytes": 0}
+response_cache_lock = threading.Lock()
+terrain_lock = threading.Lock()  # 地形產品只計算一次 (計算執行緒池中多個端點可能同時要求)
+cog_lock = threading.Lock()  # 替換開啟中的資料集與更新資料版本需原子化，避免過時的 COG 蓋掉新上傳的檔案
+retired_datasets = []  # 轉換為 COG 後被替換的 rasterio 資料集，可能仍被其他執行緒使用，清除時才關閉
+ingest_state = {}  # 各類型 (ortho/laz/dsm) 最近一次上傳的接收與匯入狀態
+ingest_executor = None
+compute_state = {"executor": None, "groups": {}}
+
+
+def cleanup_all(keep: tuple = ()):
+    """清除所有快取和刪除上傳的檔案
 
-def cleanup_all():
-    """清除所有快取和刪除上傳的檔案"""
+    Args:
+        keep: 保留的上傳檔案類型 (如 ("laz",))，檔案與路徑保留，快取仍清除
+    """
     global uploaded_files, ortho_cache, pointcloud_cache, dsm_cache
     global ref_ortho_cache, ref_dsm_cache, change_detection_cache
-    global landcover_cache, processing_state
+    global landcover_cache
 
     # 關閉 rasterio 資源
     if ortho_cache["src"] is not None:
@@ -168,9 +310,18 @@ def cleanup_all():
             ortho_cache["src"].close()
         except:
             pass
+    for ds in retired_datasets:
+        try:
+            ds.close()
+        except:
+            pass
+    retired_datasets.clear()
+    remove_cog("ortho")
 
     # 刪除所有上傳的檔案
     for key, filepath in uploaded_files.items():
+        if key in keep:
+            continue
         if filepath and os.path.exists(filepath):
             try:
                 os.remove(filepath)
@@ -179,15 +330,20 @@ def cleanup_all():
                 print(f"[Cleanup] Failed to delete {filepath}: {e}")
 
     # 重設所有快取
-    uploaded_files.update({"ortho": None, "laz": None, "dsm": None, "ortho_ref": None, "dsm_ref": None})
-    ortho_cache.update({"src": None, "transform": None, "crs": None, "bounds": None, "width": 0, "height": 0, "pixel_w": 0, "pixel_h": 0})
-    pointcloud_cache.update({"X": None, "Y": None, "Z": None, "loaded": False})
-    dsm_cache.update({"data": None, "transform": None, "crs": None, "loaded": False, "nodata": None})
+    uploaded_files.update({key: None for key in ("ortho", "laz", "dsm", "ortho_ref", "dsm_ref") if key not in keep})
+    ortho_cache.update({"src": None, "transform": None, "crs": None, "bounds": None, "width": 0, "height": 0, "pixel_w": 0, "pixel_h": 0, "valid_mask": None, "radiometry": None, "stretch_lut": None})
+    pointcloud_cache.update({"X": None, "Y": None, "Z": None, "index": None, "origin": None, "stats": None, "grids": None, "ground": None, "loaded": False})
+    close_dsm()
+    remove_cog("dsm")
     ref_ortho_cache.update({"data": None, "transform": None, "loaded": False})
     ref_dsm_cache.update({"data": None, "transform": None, "loaded": False})
     change_detection_cache.update({"result": None, "computed": False})
-    landcover_cache.update({"mask": None, "stats": None, "computed": False})
-    processing_state.update({"job_id": None, "status": "idle", "progress": 0, "current_step": "", "elapsed_seconds": 0, "results": [], "start_time": None})
+    remove_landcover_mask()
+    landcover_cache.update({"mask": None, "mask_path": None, "stats": None, "computed": False, "skipped_tiles": 0, "resolution": None})
+    job_manager.clear()
+
+    with cog_lock:
+        bump_data_version(*data_versions)
 
     print("[Cleanup] All caches cleared")
 
@@ -202,6 +358,11 @@ class ProcessingRequest(BaseModel):
     include_elevation: bool = True
     include_terrain: bool = False  # 地形分析（需要 DSM）
     include_landcover: bool = False  # 土地覆蓋偵測（UPerNet）
+    batch_size: int = 0  # YOLO 批次大小（0 = 依可用記憶體自動決定）
+    tiling_mode: str = "adaptive"  # 切片模式：adaptive（依物件尺寸計算重疊）或 dense（固定 overlap 850）
+    parallel_workers: int = 0  # CPU 多行程推論 worker 數（0 = 關閉，-1 = 依核心數）
+    landcover_gsd: float = 0  # 土地覆蓋推論解析度（公尺，0 = 原始解析度）
+    priority: int = 0  # 工作佇列優先權（數字大者先執行）
 
 # ============================================
 # 核心函式
@@ -231,19 +392,366 @@ def load_yolo_models():
     return models
 
 
-def run_yolo_detection(classes_to_detect: list[str], progress_callback=None) -> list[dict]:
-    import rasterio
+def get_available_memory() -> int:
+    """取得可用記憶體 (bytes)，有 GPU 時回傳 GPU 剩餘記憶體"""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            free, _ = torch.cuda.mem_get_info()
+            return int(free)
+    except Exception:
+        pass
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 2 * 1024 ** 3
+
+
+def resolve_batch_size(patch_size: int, batch_size: int = None) -> int:
+    """決定 YOLO 批次大小 (batch_size <= 0 時依可用記憶體自動計算)"""
+    cfg = YOLO_BATCH_CONFIG
+    if batch_size is None:
+        batch_size = cfg["batch_size"]
+    if batch_size and batch_size > 0:
+        return int(batch_size)
+
+    per_patch = patch_size * patch_size * cfg["bytes_per_pixel"]
+    budget = get_available_memory() * cfg["memory_fraction"]
+    return int(max(1, min(cfg["max_batch_size"], budget // per_patch)))
+
+
+class DetectionBuffer:
+    """原始偵測結果的欄式暫存：每個類別保存整批 (N, 4) 框與 (N,) 信心值陣列，
+    NMS / OBIA 全部以陣列運算，只在 API 輸出時才轉為 dict"""
+
+    def __init__(self):
+        self._boxes = {}
+        self._scores = {}
+
+    def add(self, cls_name: str, boxes: np.ndarray, scores: np.ndarray, x: int = 0, y: int = 0):
+        """加入一批框 (patch 座標)，並平移 (x, y) 視窗偏移"""
+        if len(boxes) == 0:
+            return
+        boxes = np.asarray(boxes, dtype=np.float32) + np.array([x, y, x, y], dtype=np.float32)
+        self._boxes.setdefault(cls_name, []).append(boxes)
+        self._scores.setdefault(cls_name, []).append(np.asarray(scores, dtype=np.float32))
+
+    def get(self, cls_name: str) -> tuple[np.ndarray, np.ndarray]:
+        """取得某類別所有框 (N, 4) 與信心值 (N,)"""
+        if cls_name not in self._boxes:
+            return np.zeros((0, 4), np.float32), np.zeros(0, np.float32)
+        if len(self._boxes[cls_name]) > 1:
+            self._boxes[cls_name] = [np.concatenate(self._boxes[cls_name])]
+            self._scores[cls_name] = [np.concatenate(self._scores[cls_name])]
+        return self._boxes[cls_name][0], self._scores[cls_name][0]
+
+    def __len__(self):
+        return sum(len(b) for chunks in self._boxes.values() for b in chunks)
+
+
+def run_yolo_batch(model, cls_name: str, batch: list[tuple], raw: DetectionBuffer):
+    """一次推論多個 patch，並將結果依各自的視窗偏移加回原圖座標
+
+    Args:
+        batch: [(x, y, patch), ...]
+    """
+    cfg = MODELS_CONFIG[cls_name]
+    results = model([patch for _, _, patch in batch], conf=cfg["conf"], verbose=False)
+
+    for (x, y, _), result in zip(batch, results):
+        boxes = result.boxes
+        if boxes is None or len(boxes) == 0:
+            continue
+        raw.add(cls_name, boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), x, y)
+
+
+def plan_tiling(classes_to_detect: list[str], mode: str = None) -> dict:
+    """規劃 YOLO 切片 (重疊、步長、切片數與預估時間)
+
+    adaptive: 最大物件邊長 = sqrt(最大面積 x 最大長寬比)，換算成像素後乘上安全係數作為重疊，
+    保證任何物件至少完整落在一個 patch 內；dense: 使用 MODELS_CONFIG 固定的 overlap。
+    """
+    mode = mode or TILING_CONFIG["mode"]
+    if mode not in ("adaptive", "dense"):
+        raise ValueError(f"Unknown tiling mode: {mode}")
+    if ortho_cache["src"] is None:
+        raise ValueError("No ortho image loaded")
+
+    gsd = min(abs(ortho_cache["pixel_w"]), abs(ortho_cache["pixel_h"])) or 1.0
+
+    classes = {}
+    for cls_name in classes_to_detect:
+        if cls_name not in MODELS_CONFIG:
+            continue
+        cfg = MODELS_CONFIG[cls_name]
+        patch_size = cfg["patch_size"]
+        max_side_px = np.sqrt(cfg["area"][1] * cfg["ratio"][1]) / gsd
+        min_overlap = int(np.ceil(max_side_px * TILING_CONFIG["safety_factor"]))
+        min_overlap = min(max(min_overlap, TILING_CONFIG["min_overlap"]), cfg["overlap"], patch_size - 1)
+        classes[cls_name] = {
+            "patch_size": patch_size,
+            "max_object_px": round(float(max_side_px), 1),
+            "min_overlap": min_overlap,
+            "overlap": cfg["overlap"] if mode == "dense" else min_overlap,
+        }
+
+    # 相同 patch_size 的類別共用同一組視窗，重疊取其中最大者
+    passes = {}
+    for cls_name, info in classes.items():
+        key = (info["patch_size"], info["overlap"]) if mode == "dense" else info["patch_size"]
+        p = passes.setdefault(key, {"classes": [], "patch_size": info["patch_size"], "overlap": 0})
+        p["classes"].append(cls_name)
+        p["overlap"] = max(p["overlap"], info["overlap"])
+
+    try:
+        import torch
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        device = "cpu"
+    sec_per_tile = TILING_CONFIG["seconds_per_tile"][device]
+
+    total_tiles = 0
+    model_runs = 0
+    dense_runs = 0
+    estimated = 0.0
+    skipped_tiles = 0
+    for p in passes.values():
+        p["step"] = p["patch_size"] - p["overlap"]
+        windows, p["skipped"] = data_windows(p["patch_size"], p["step"])
+        p["tiles"] = len(windows)
+        total_tiles += p["tiles"]
+        skipped_tiles += p["skipped"]
+        model_runs += p["tiles"] * len(p["classes"])
+        estimated += p["tiles"] * len(p["classes"]) * sec_per_tile * (p["patch_size"] / 1024) ** 2
+        for cls_name in p["classes"]:
+            cfg = MODELS_CONFIG[cls_name]
+            dense_runs += count_ortho_tiles(cfg["patch_size"], cfg["patch_size"] - cfg["overlap"])
+
+    return {
+        "mode": mode,
+        "device": device,
+        "gsd": gsd,
+        "classes": classes,
+        "passes": list(passes.values()),
+        "total_tiles": total_tiles,
+        "skipped_tiles": skipped_tiles,
+        "model_runs": model_runs,
+        "estimated_seconds": round(estimated, 1),
+        "speedup_vs_dense": round(dense_runs / model_runs, 1) if model_runs else 1.0,
+    }
+
+
+def count_ortho_tiles(patch_size: int, step: int) -> int:
+    """計算正射影像切片數量"""
+    width = ortho_cache["width"]
+    height = ortho_cache["height"]
+    return ((height + step - 1) // step) * ((width + step - 1) // step)
+
+
+def read_ortho_patch(src, x: int, y: int, patch_size: int) -> np.ndarray:
+    """讀取單一視窗 (HWC, 前 3 個 band)，不足 patch_size 的邊緣補零"""
     from rasterio.windows import Window
+
+    win_w = min(patch_size, src.width - x)
+    win_h = min(patch_size, src.height - y)
+
+    patch = src.read(window=Window(x, y, win_w, win_h))
+    patch = np.moveaxis(patch[:3], 0, -1)
+
+    if patch.shape[0] < patch_size or patch.shape[1] < patch_size:
+        padded = np.zeros((patch_size, patch_size, 3), dtype=patch.dtype)
+        padded[:patch.shape[0], :patch.shape[1]] = patch
+        patch = padded
+    return patch
+
+
+class PrefetchTileReader:
+    """背景預讀視窗：執行緒池依序讀取並補零，最多保留 depth 個 patch，
+    讓 GeoTIFF 解壓縮與模型推論重疊進行。依 windows 順序 yield (x, y, patch)。"""
+
+    def __init__(self, path: str, windows: list[tuple], patch_size: int, depth: int = None, workers: int = None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.path = path
+        self.windows = windows
+        self.patch_size = patch_size
+        self.depth = max(1, depth or PREFETCH_CONFIG["depth"])
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers or PREFETCH_CONFIG["workers"]),
+                                            thread_name_prefix="prefetch")
+        self._local = threading.local()
+        self._datasets = []
+        self._lock = threading.Lock()
+        self._stats = {"tiles": 0, "depth_sum": 0, "empty_waits": 0, "wait_seconds": 0.0, "read_seconds": 0.0}
+
+    def _read(self, x: int, y: int) -> np.ndarray:
+        import rasterio
+
+        src = getattr(self._local, "src", None)
+        if src is None:
+            src = rasterio.open(self.path)
+            self._local.src = src
+            with self._lock:
+                self._datasets.append(src)
+
+        t0 = time.time()
+        patch = read_ortho_patch(src, x, y, self.patch_size)
+        with self._lock:
+            self._stats["read_seconds"] += time.time() - t0
+        return patch
+
+    def __iter__(self):
+        from collections import deque
+
+        pending = deque()
+        windows = iter(self.windows)
+        try:
+            for x, y in windows:
+                pending.append((x, y, self._executor.submit(self._read, x, y)))
+                if len(pending) >= self.depth:
+                    break
+
+            while pending:
+                x, y, future = pending.popleft()
+                ready = sum(1 for *_, f in pending if f.done()) + future.done()
+                self._stats["depth_sum"] += ready
+                if not future.done():
+                    self._stats["empty_waits"] += 1
+
+                t0 = time.time()
+                patch = future.result()
+                self._stats["wait_seconds"] += time.time() - t0
+                self._stats["tiles"] += 1
+                prefetch_stats.update(self.stats())
+
+                nxt = next(windows, None)
+                if nxt is not None:
+                    pending.append((nxt[0], nxt[1], self._executor.submit(self._read, *nxt)))
+
+                yield x, y, patch
+        finally:
+            for *_, future in pending:
+                future.cancel()
+            self.close()
+
+    def stats(self) -> dict:
+        """佇列深度統計：平均就緒數、取用時需等待的次數與時間"""
+        n = max(self._stats["tiles"], 1)
+        return {
+            "tiles": self._stats["tiles"],
+            "depth": self.depth,
+            "avg_ready": round(self._stats["depth_sum"] / n, 2),
+            "empty_waits": self._stats["empty_waits"],
+            "wait_seconds": round(self._stats["wait_seconds"], 2),
+            "read_seconds": round(self._stats["read_seconds"], 2),
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for src in self._datasets:
+                try:
+                    src.close()
+                except Exception:
+                    pass
+            self._datasets = []
+        prefetch_stats.update(self.stats())
+
+
+def ortho_windows(step: int) -> list[tuple]:
+    """正射影像切片左上角座標 [(x, y), ...]"""
+    width = ortho_cache["width"]
+    height = ortho_cache["height"]
+    return [(x, y) for y in range(0, height, step) for x in range(0, width, step)]
+
+
+def get_valid_mask() -> dict:
+    """低解析度有效像素遮罩 (每個正射影像只計算一次)
+
+    有 mask / nodata / alpha 時直接讀取 dataset mask；否則以平均重採樣讀取低解析度影像，
+    三個 band 都 <= dark_threshold 的格子視為 nodata。回傳 {"mask", "factor", "source", "sat"}。
+    """
+    if ortho_cache["valid_mask"] is not None:
+        return ortho_cache["valid_mask"]
+
+    from rasterio.enums import MaskFlags, Resampling
+
+    src = ortho_reader()
+    factor = max(1, int(np.ceil(max(src.width, src.height) / NODATA_CONFIG["max_mask_size"])))
+    out_shape = (int(np.ceil(src.height / factor)), int(np.ceil(src.width / factor)))
+
+    if MaskFlags.all_valid not in src.mask_flag_enums[0]:
+        valid = src.dataset_mask(out_shape=out_shape, resampling=Resampling.average) > 0
+        source = "mask"
+    else:
+        data = src.read([1, 2, 3], out_shape=(3,) + out_shape, resampling=Resampling.average)
+        threshold = NODATA_CONFIG["dark_threshold"] if data.dtype == np.uint8 else 0
+        valid = ~np.all(data <= threshold, axis=0)
+        source = "overview"
+
+    # 積分影像：任意視窗內的有效格數為 O(1) 查詢
+    sat = np.zeros((out_shape[0] + 1, out_shape[1] + 1), np.int64)
+    sat[1:, 1:] = valid.cumsum(0).cumsum(1)
+
+    ortho_cache["valid_mask"] = {"mask": valid, "factor": factor, "source": source, "sat": sat}
+    print(f"[Ortho] Valid mask ({source}): {valid.mean() * 100:.1f}% of {out_shape[1]}x{out_shape[0]}")
+    return ortho_cache["valid_mask"]
+
+
+def tiles_have_data(xs, ys, tile_w: int, tile_h: int) -> np.ndarray:
+    """判斷多個視窗 (左上角 xs, ys) 內是否有任何有效像素"""
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    if not NODATA_CONFIG["skip_empty"] or len(xs) == 0:
+        return np.ones(len(xs), dtype=bool)
+
+    vm = get_valid_mask()
+    f, sat = vm["factor"], vm["sat"]
+    rows, cols = vm["mask"].shape
+    r0 = np.clip(ys // f, 0, rows)
+    c0 = np.clip(xs // f, 0, cols)
+    r1 = np.clip(-(-(ys + tile_h) // f), 0, rows)
+    c1 = np.clip(-(-(xs + tile_w) // f), 0, cols)
+    return (sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]) > 0
+
+
+def data_windows(patch_size: int, step: int) -> tuple[list[tuple], int]:
+    """有資料的切片座標與略過的空白切片數"""
+    windows = ortho_windows(step)
+    if not windows:
+        return windows, 0
+    xs, ys = np.array(windows).T
+    keep = tiles_have_data(xs, ys, patch_size, patch_size)
+    return [w for w, k in zip(windows, keep) if k], int((~keep).sum())
+
+
+def iter_ortho_tiles(patch_size: int, step: int) -> PrefetchTileReader:
+    """依序讀取有資料的正射影像視窗 (背景預讀)，不足 patch_size 的邊緣補零
+
+    Yields:
+        (x, y, patch)，patch 為 (patch_size, patch_size, 3)
+    """
+    windows, _ = data_windows(patch_size, step)
+    return PrefetchTileReader(ortho_cache["src"].name, windows, patch_size)
+
+
+def run_yolo_detection(classes_to_detect: list[str], progress_callback=None, batch_size: int = None,
+                       tiling_mode: str = None, workers: int = None) -> list[dict]:
     import torch
     from torchvision.ops import nms
 
     if ortho_cache["src"] is None:
         raise ValueError("No ortho image loaded")
 
-    src = ortho_cache["src"]
     transform = ortho_cache["transform"]
-    width = ortho_cache["width"]
-    height = ortho_cache["height"]
     pixel_w = ortho_cache["pixel_w"]
     pixel_h = ortho_cache["pixel_h"]
 
@@ -251,115 +759,116 @@ def run_yolo_detection(classes_to_detect: list[str], progress_callback=None) ->
     if not models:
         raise ValueError("No YOLO models loaded")
 
-    raw_detections = []
-    total_classes = len(classes_to_detect)
+    # 同一 pass 的類別共用同一組視窗，每個視窗只讀取一次
+    plan = plan_tiling([c for c in classes_to_detect if c in models], tiling_mode)
+    print(f"[YOLO] Tiling ({plan['mode']}): {plan['total_tiles']} tiles "
+          f"({plan['skipped_tiles']} empty skipped), ~{plan['estimated_seconds']}s")
 
-    for cls_idx, cls_name in enumerate(classes_to_detect):
-        if cls_name not in models:
+    raw = DetectionBuffer()
+    total_work = plan["model_runs"]
+    work_done = 0
+    n_workers = resolve_worker_count(workers)
+
+    for p in plan["passes"]:
+        patch_size, step, group_classes = p["patch_size"], p["step"], p["classes"]
+        n_batch = resolve_batch_size(patch_size, batch_size)
+        total_patches = p["tiles"]
+        patch_count = 0
+        batch = []
+        label = ", ".join(group_classes)
+        print(f"[YOLO] {label}: {total_patches} patches ({p['skipped']} empty skipped), "
+              f"overlap={p['overlap']}, batch_size={n_batch}, workers={n_workers}")
+
+        if n_workers > 1:
+            def report(done, base=work_done, n_cls=len(group_classes), label=label, total=total_patches):
+                if progress_callback:
+                    progress = 20 + ((base + done * n_cls) / max(total_work, 1)) * 50
+                    progress_callback(int(progress), f"Detecting {label} ({done}/{total})...")
+
+            run_yolo_pass_parallel(group_classes, data_windows(patch_size, step)[0], patch_size,
+                                   max(1, n_batch // n_workers), n_workers, raw, report)
+            work_done += total_patches * len(group_classes)
             continue
 
-        model = models[cls_name]
-        cfg = MODELS_CONFIG[cls_name]
-        patch_size = cfg["patch_size"]
-        step = patch_size - cfg["overlap"]
+        reader = iter_ortho_tiles(patch_size, step)
+        for x, y, patch in reader:
+            batch.append((x, y, patch))
+            patch_count += 1
+            if len(batch) < n_batch and patch_count < total_patches:
+                continue
 
-        rows = list(range(0, height, step))
-        total_patches = len(rows) * ((width + step - 1) // step)
-        patch_count = 0
+            for cls_name in group_classes:
+                run_yolo_batch(models[cls_name], cls_name, batch, raw)
+            work_done += len(batch) * len(group_classes)
+            batch = []
+
+            if progress_callback:
+                progress = 20 + (work_done / max(total_work, 1)) * 50
+                progress_callback(int(progress), f"Detecting {label} ({patch_count}/{total_patches})...")
 
-        for y in rows:
-            for x in range(0, width, step):
-                win_w = min(patch_size, width - x)
-                win_h = min(patch_size, height - y)
-
-                patch = src.read(window=Window(x, y, win_w, win_h))
-                patch = np.moveaxis(patch[:3], 0, -1)
-
-                if patch.shape[0] < patch_size or patch.shape[1] < patch_size:
-                    padded = np.zeros((patch_size, patch_size, 3), dtype=patch.dtype)
-                    padded[:patch.shape[0], :patch.shape[1]] = patch
-                    patch = padded
-
-                results = model(patch, conf=cfg["conf"], verbose=False)
-
-                for result in results:
-                    boxes = result.boxes
-                    if boxes is None:
-                        continue
-                    for i in range(len(boxes)):
-                        bx = boxes.xyxy[i].cpu().numpy()
-                        conf = float(boxes.conf[i].cpu())
-                        raw_detections.append({
-                            "class": cls_name,
-                            "conf": conf,
-                            "px1": x + bx[0], "py1": y + bx[1],
-                            "px2": x + bx[2], "py2": y + bx[3],
-                        })
-
-                patch_count += 1
-                if progress_callback and patch_count % 10 == 0:
-                    progress = 20 + (cls_idx / total_classes) * 50 + (patch_count / total_patches) * (50 / total_classes)
-                    progress_callback(int(progress), f"Detecting {cls_name}...")
-
-    print(f"[YOLO] Raw: {len(raw_detections)}")
-
-    # NMS
-    final_detections = []
+        print(f"[YOLO] Prefetch: {reader.stats()}")
+
+    print(f"[YOLO] Raw: {len(raw)}")
+
+    # NMS (每個類別整批 tensor 一次完成)
+    kept = {}
     for cls_name in classes_to_detect:
         if cls_name not in MODELS_CONFIG:
             continue
-        cfg = MODELS_CONFIG[cls_name]
-        cls_raw = [r for r in raw_detections if r["class"] == cls_name]
-        if not cls_raw:
+        boxes, scores = raw.get(cls_name)
+        if len(boxes) == 0:
             continue
+        keep = nms(torch.from_numpy(boxes), torch.from_numpy(scores), MODELS_CONFIG[cls_name]["nms_iou"]).numpy()
+        kept[cls_name] = (boxes[keep], scores[keep])
 
-        boxes = torch.tensor([[r["px1"], r["py1"], r["px2"], r["py2"]] for r in cls_raw])
-        scores = torch.tensor([r["conf"] for r in cls_raw])
-        keep = nms(boxes, scores, cfg["nms_iou"])
-        final_detections.extend([cls_raw[int(i)] for i in keep])
-
-    print(f"[YOLO] After NMS: {len(final_detections)}")
+    print(f"[YOLO] After NMS: {sum(len(b) for b, _ in kept.values())}")
 
-    # OBIA
+    # OBIA (向量化面積 / 長寬比過濾與地理座標轉換)
     records = []
-    id_counter = {k: 0 for k in MODELS_CONFIG}
-
-    for r in final_detections:
-        cls_name = r["class"]
+    for cls_name, (boxes, scores) in kept.items():
         cfg = MODELS_CONFIG[cls_name]
+        boxes = boxes.astype(np.float64)
 
-        w_m = (r["px2"] - r["px1"]) * pixel_w
-        h_m = (r["py2"] - r["py1"]) * pixel_h
+        w_m = (boxes[:, 2] - boxes[:, 0]) * pixel_w
+        h_m = (boxes[:, 3] - boxes[:, 1]) * pixel_h
         area = w_m * h_m
-        aspect = max(w_m, h_m) / (min(w_m, h_m) + 1e-6)
+        aspect = np.maximum(w_m, h_m) / (np.minimum(w_m, h_m) + 1e-6)
 
-        if not (cfg["area"][0] <= area <= cfg["area"][1]):
-            continue
-        if not (cfg["ratio"][0] <= aspect <= cfg["ratio"][1]):
-            continue
+        m = (area >= cfg["area"][0]) & (area <= cfg["area"][1]) & \
+            (aspect >= cfg["ratio"][0]) & (aspect <= cfg["ratio"][1])
+        boxes, scores, area, aspect = boxes[m], scores[m], area[m], aspect[m]
+
+        cx = (boxes[:, 0] + boxes[:, 2]) / 2
+        cy = (boxes[:, 1] + boxes[:, 3]) / 2
+        gx = transform.a * cx + transform.b * cy + transform.c
+        gy = transform.d * cx + transform.e * cy + transform.f
 
-        id_counter[cls_name] += 1
-        cx = (r["px1"] + r["px2"]) / 2
-        cy = (r["py1"] + r["py2"]) / 2
-        gx, gy = transform * (cx, cy)
+        records.extend(build_detection_records(cls_name, boxes, scores, area, aspect, gx, gy))
 
+    print(f"[YOLO] After OBIA: {len(records)}")
+    return records
+
+
+def build_detection_records(cls_name, boxes, scores, area, aspect, gx, gy) -> list[dict]:
+    """將欄式偵測結果轉為 API 輸出的 dict 列表"""
+    records = []
+    for i in range(len(boxes)):
+        px1, py1, px2, py2 = (float(v) for v in boxes[i])
         records.append({
-            "id": id_counter[cls_name],
+            "id": i + 1,
             "cls": "vehicle" if cls_name == "car" else cls_name,
-            "score": round(r["conf"], 3),
-            "center_x": round(gx, 2),
-            "center_y": round(gy, 2),
-            "area_m2": round(area, 2),
-            "aspect_rat": round(aspect, 2),
-            "px1": r["px1"], "py1": r["py1"],
-            "px2": r["px2"], "py2": r["py2"],
+            "score": round(float(scores[i]), 3),
+            "center_x": round(float(gx[i]), 2),
+            "center_y": round(float(gy[i]), 2),
+            "area_m2": round(float(area[i]), 2),
+            "aspect_rat": round(float(aspect[i]), 2),
+            "px1": px1, "py1": py1,
+            "px2": px2, "py2": py2,
             "elev_z": 0.0,
             "height_m": 0.0,
             "lat": 0.0,
             "lon": 0.0,
         })
-
-    print(f"[YOLO] After OBIA: {len(records)}")
     return records
 
 
@@ -408,361 +917,2091 @@ def load_upernet_model():
         return None
 
 
-def run_landcover_segmentation(progress_callback=None) -> dict:
-    """執行土地覆蓋分割"""
-    import torch
-    import torchvision.transforms as T
-    import cv2
-
-    if ortho_cache["src"] is None:
-        raise ValueError("No ortho image loaded")
-
-    model = load_upernet_model()
-    if model is None:
-        raise ValueError("Failed to load UPerNet model")
+def landcover_blend_weights(tile_size: tuple) -> np.ndarray:
+    """切片融合權重 (th, tw)：gaussian 降低切片邊緣預測的權重，uniform 為單純平均"""
+    th, tw = tile_size
+    if UPERNET_CONFIG["blend"] != "gaussian":
+        return np.ones((th, tw), np.float32)
 
-    device = upernet_cache["device"]
-    src = ortho_cache["src"]
+    sigma = UPERNET_CONFIG["gaussian_sigma"]
+    gy = np.exp(-0.5 * ((np.arange(th) - (th - 1) / 2) / (sigma * th)) ** 2)
+    gx = np.exp(-0.5 * ((np.arange(tw) - (tw - 1) / 2) / (sigma * tw)) ** 2)
+    weights = np.outer(gy, gx).astype(np.float32)
+    return np.maximum(weights / weights.max(), 1e-3)
 
-    # Read image
-    data = src.read([1, 2, 3])
-    img = np.moveaxis(data, 0, -1)
 
-    # Normalize to uint8 if needed
-    if img.dtype != np.uint8:
-        img = img.astype(np.float32)
-        img = (img - img.min()) / max(img.max() - img.min(), 1e-6) * 255
-        img = img.astype(np.uint8)
+def accumulate_landcover_band(model, device, img_pad: np.ndarray, tile_size: tuple, strides: tuple,
+                              progress_callback=None, tile_valid: np.ndarray = None, batch_size: int = None) -> tuple:
+    """對已補邊影像做批次滑動視窗推論，logits 依融合權重累加在 torch device 上
 
-    H, W = img.shape[:2]
-    th, tw = UPERNET_CONFIG["tile_size"]
-    overlap = UPERNET_CONFIG["overlap"]
-    num_classes = UPERNET_CONFIG["num_classes"]
+    Args:
+        tile_valid: (切片列數, 切片行數) 布林陣列，False 的空白切片直接略過
 
-    stride_h = max(1, int(th * (1 - overlap)))
-    stride_w = max(1, int(tw * (1 - overlap)))
+    Returns:
+        (logit_sum, weight_sum) numpy 陣列
+    """
+    import torch
 
-    # Padding
-    pad_h = max(((H - th) // stride_h + 1) * stride_h + th - H, 0)
-    pad_w = max(((W - tw) // stride_w + 1) * stride_w + tw - W, 0)
-    img_pad = cv2.copyMakeBorder(img, 0, pad_h, 0, pad_w, cv2.BORDER_REFLECT_101)
+    th, tw = tile_size
+    stride_h, stride_w = strides
     Hp, Wp = img_pad.shape[:2]
+    num_classes = UPERNET_CONFIG["num_classes"]
+    batch_size = max(1, batch_size or UPERNET_CONFIG["batch_size"])
 
-    # Accumulators
-    logit_sum = np.zeros((num_classes, Hp, Wp), np.float32)
-    count = np.zeros((Hp, Wp), np.float32)
-
-    to_tensor = T.Compose([
-        T.ToTensor(),
-        T.Normalize(IMAGENET_MEAN, IMAGENET_STD)
-    ])
+    logit_sum = torch.zeros((num_classes, Hp, Wp), dtype=torch.float32, device=device)
+    weight_sum = torch.zeros((Hp, Wp), dtype=torch.float32, device=device)
+    weights = torch.from_numpy(landcover_blend_weights(tile_size)).to(device)
+    mean = torch.tensor(IMAGENET_MEAN, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, dtype=torch.float32, device=device).view(1, 3, 1, 1)
 
-    # Calculate total tiles for progress
-    total_tiles = ((Hp - th) // stride_h + 1) * ((Wp - tw) // stride_w + 1)
-    tile_count = 0
+    positions = []
+    for i, y in enumerate(range(0, Hp - th + 1, stride_h)):
+        for j, x in enumerate(range(0, Wp - tw + 1, stride_w)):
+            if tile_valid is None or tile_valid[i, j]:
+                positions.append((y, x))
 
-    # Sliding window inference
+    total_tiles = len(positions)
     with torch.no_grad():
-        for y in range(0, Hp - th + 1, stride_h):
-            for x in range(0, Wp - tw + 1, stride_w):
-                tile = img_pad[y:y+th, x:x+tw]
-                tin = to_tensor(tile).unsqueeze(0).to(device)
-                logits = model(tin)
-                logits = logits[0] if isinstance(logits, (list, tuple)) else logits
-                logit_sum[:, y:y+th, x:x+tw] += logits.squeeze(0).cpu().numpy()
-                count[y:y+th, x:x+tw] += 1
-
-                tile_count += 1
-                if progress_callback and tile_count % 100 == 0:
-                    progress = int(tile_count / total_tiles * 100)
-                    progress_callback(progress, f"Landcover segmentation ({tile_count}/{total_tiles})...")
-
-    # Get prediction
-    pred = np.argmax(logit_sum / np.maximum(count, 1e-6), axis=0).astype(np.uint8)
-    pred = pred[:H, :W]
-
-    # Handle nodata (black pixels)
-    black_mask = np.all(img <= 10, axis=2)
-    pred[black_mask] = 255
-
-    # Compute statistics
-    stats = {}
-    total_valid = np.sum(pred < num_classes)
-    for class_id, class_name in LANDCOVER_CLASSES.items():
-        class_pixels = np.sum(pred == class_id)
-        stats[class_name] = {
-            "pixels": int(class_pixels),
-            "percentage": round(class_pixels / total_valid * 100, 2) if total_valid > 0 else 0
-        }
+        for start in range(0, total_tiles, batch_size):
+            batch = positions[start:start + batch_size]
+            tiles = np.stack([img_pad[y:y+th, x:x+tw] for y, x in batch])
 
-    # Cache results
-    landcover_cache["mask"] = pred
-    landcover_cache["stats"] = stats
-    landcover_cache["computed"] = True
+            tin = torch.from_numpy(tiles).to(device).permute(0, 3, 1, 2).float().div_(255)
+            tin = (tin - mean) / std
+            logits = model(tin)
+            logits = logits[0] if isinstance(logits, (list, tuple)) else logits
 
-    print(f"[UPerNet] Segmentation complete: {H}x{W}")
-    return {"stats": stats, "shape": (H, W)}
+            for k, (y, x) in enumerate(batch):
+                logit_sum[:, y:y+th, x:x+tw] += logits[k] * weights
+                weight_sum[y:y+th, x:x+tw] += weights
 
+            if progress_callback:
+                progress_callback(start + len(batch), total_tiles)
 
-def get_landcover_colorized() -> np.ndarray:
-    """取得彩色土地覆蓋圖"""
-    if not landcover_cache["computed"] or landcover_cache["mask"] is None:
-        return None
+    return logit_sum.cpu().numpy(), weight_sum.cpu().numpy()
 
-    mask = landcover_cache["mask"]
-    H, W = mask.shape
-    color_img = np.zeros((H, W, 3), dtype=np.uint8)
 
-    for class_id, class_name in LANDCOVER_CLASSES.items():
-        color = LANDCOVER_COLORS[class_name]
-        color_img[mask == class_id] = color
+def accumulate_landcover_parallel(pool, img_pad: np.ndarray, tile_size: tuple, strides: tuple,
+                                  progress_callback=None, tile_valid: np.ndarray = None, batch_size: int = None) -> tuple:
+    """將切片列分段交給行程池 (create_worker_pool) 推論，再把各段 logits 加回累加陣列"""
+    from concurrent.futures import as_completed
 
-    # Set nodata to black
-    color_img[mask == 255] = [0, 0, 0]
+    th, tw = tile_size
+    stride_h, stride_w = strides
+    Hp, Wp = img_pad.shape[:2]
+    num_classes = UPERNET_CONFIG["num_classes"]
 
-    return color_img
+    logit_sum = np.zeros((num_classes, Hp, Wp), np.float32)
+    count = np.zeros((Hp, Wp), np.float32)
 
+    rows = list(range(0, Hp - th + 1, stride_h))
+    cols = (Wp - tw) // stride_w + 1
+    chunk = PARALLEL_CONFIG["chunk_rows"]
+    bands = [(i, rows[i], rows[min(i + chunk, len(rows)) - 1] + th, min(chunk, len(rows) - i))
+             for i in range(0, len(rows), chunk)]
+    total_tiles = len(rows) * cols
+    tile_count = 0
 
-def sample_trunc_normal(mean, std, low, high):
-    for _ in range(60):
-        v = rng.normal(mean, std)
-        if low <= v <= high:
-            return float(v)
-    return float(rng.uniform(low, high))
+    futures = {}
+    for i, y0, y1, n_rows in bands:
+        band_valid = tile_valid[i:i + n_rows] if tile_valid is not None else None
+        if band_valid is not None and not band_valid.any():
+            tile_count += n_rows * cols
+            continue
+        future = pool.submit(_landcover_worker_band, img_pad[y0:y1], tile_size, strides, band_valid, batch_size)
+        futures[future] = (y0, y1, n_rows)
 
+    for future in as_completed(futures):
+        y0, y1, n_rows = futures[future]
+        band_logits, band_count = future.result()
+        logit_sum[:, y0:y1] += band_logits
+        count[y0:y1] += band_count
 
-def impute_height_by_class(cls_name, h_raw, n_pts, min_pts):
-    hmin, hmax = HEIGHT_RANGE.get(cls_name, (0.0, float('inf')))
-    prior = HEIGHT_PRIOR.get(cls_name, {"mean": (hmin + hmax) / 2.0, "std": 0.1})
+        tile_count += n_rows * cols
+        if progress_callback:
+            progress_callback(tile_count, total_tiles)
 
-    def draw():
-        return sample_trunc_normal(prior["mean"], prior["std"], hmin, hmax)
+    return logit_sum, count
 
-    if n_pts == 0 or not np.isfinite(h_raw) or h_raw < hmin or h_raw > hmax:
-        return draw(), "imputed"
-    return float(h_raw), "ok"
 
+def compute_ortho_radiometry(src) -> dict:
+    """計算前 3 個 band 的直方圖與百分位拉伸參數
 
-def compute_height_volume(detections, progress_callback=None):
-    if not pointcloud_cache["loaded"]:
-        for det in detections:
-            cls = det["cls"] if det["cls"] != "vehicle" else "car"
-            h, _ = impute_height_by_class(cls, np.nan, 0, 100)
-            det["height_m"] = round(h, 2)
-        return detections
+    以最近鄰讀取最大邊長 sample_size 的降採樣影像 (有 overview 時 GDAL 直接使用)，
+    排除 dataset mask 無效與三個 band 皆為 0 的像素。拉伸範圍 low/high 取三個 band 合併的百分位，保持色彩平衡。
+    """
+    from rasterio.enums import Resampling
+
+    cfg = ORTHO_STATS_CONFIG
+    scale = max(1.0, max(src.width, src.height) / cfg["sample_size"])
+    out_shape = (max(1, int(round(src.height / scale))), max(1, int(round(src.width / scale))))
+    data = src.read([1, 2, 3], out_shape=(3,) + out_shape, resampling=Resampling.nearest)
+
+    valid = src.dataset_mask(out_shape=out_shape, resampling=Resampling.nearest) > 0
+    valid &= np.any(data != 0, axis=0)
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= np.all(np.isfinite(data), axis=0)
+    values = data[:, valid].astype(np.float64)
+    if values.size == 0:
+        values = np.zeros((3, 1))
+
+    low, high = np.percentile(values, [cfg["low_percentile"], cfg["high_percentile"]])
+    vmin, vmax = float(values.min()), float(values.max())
+    if high <= low:
+        low, high = vmin, max(vmax, vmin + 1)
+    edges = np.linspace(vmin, vmax if vmax > vmin else vmin + 1, cfg["histogram_bins"] + 1)
+
+    bands = []
+    for b in range(3):
+        band_low, band_high = np.percentile(values[b], [cfg["low_percentile"], cfg["high_percentile"]])
+        bands.append({
+            "min": float(values[b].min()),
+            "max": float(values[b].max()),
+            "mean": float(values[b].mean()),
+            "low": float(band_low),
+            "high": float(band_high),
+            "histogram": np.histogram(values[b], bins=edges)[0].tolist(),
+        })
 
-    from shapely.geometry import box
-    X, Y, Z = pointcloud_cache["X"], pointcloud_cache["Y"], pointcloud_cache["Z"]
-    transform = ortho_cache["transform"]
+    return {
+        "dtype": str(data.dtype),
+        "sample_shape": list(out_shape),
+        "valid_fraction": round(float(valid.mean()), 4),
+        "low": float(low),
+        "high": float(high),
+        "percentiles": [cfg["low_percentile"], cfg["high_percentile"]],
+        "bin_edges": [round(float(e), 6) for e in edges],
+        "bands": bands,
+    }
 
-    for det in detections:
-        cls = det["cls"] if det["cls"] != "vehicle" else "car"
-        px1, py1 = transform * (det["px1"], det["py1"])
-        px2, py2 = transform * (det["px2"], det["py2"])
-        geom = box(min(px1, px2), min(py1, py2), max(px1, px2), max(py1, py2))
-
-        minx, miny, maxx, maxy = geom.bounds
-        m = (X >= minx) & (X <= maxx) & (Y >= miny) & (Y <= maxy)
-
-        if np.any(m):
-            zz = Z[m]
-            z0 = float(np.percentile(zz, 5))
-            ztop = float(np.percentile(zz, 95))
-            h_raw = max(0.0, ztop - z0)
-            h_fix, _ = impute_height_by_class(cls, h_raw, len(zz), MIN_PTS_BY_CLASS.get(cls, 30))
-            det["height_m"] = round(h_fix, 2)
-            det["elev_z"] = round(z0, 1)
-        else:
-            h, _ = impute_height_by_class(cls, np.nan, 0, 100)
-            det["height_m"] = round(h, 2)
 
-    return detections
+def get_ortho_radiometry() -> dict:
+    """正射影像輻射統計 (非 uint8 影像於匯入時計算，其餘於首次查詢時計算，結果快取)"""
+    if ortho_cache["radiometry"] is None:
+        ortho_cache["radiometry"] = compute_ortho_radiometry(ortho_reader())
+    return ortho_cache["radiometry"]
 
 
-def add_latlon_to_detections(detections):
-    if ortho_cache["crs"] is None:
-        return detections
-    try:
-        from pyproj import Transformer
-        transformer = Transformer.from_crs(ortho_cache["crs"], "EPSG:4326", always_xy=True)
-        for det in detections:
-            lon, lat = transformer.transform(det["center_x"], det["center_y"])
-            det["lat"] = round(lat, 6)
-            det["lon"] = round(lon, 6)
-    except Exception as e:
-        print(f"[Coord] Error: {e}")
-    return detections
+def get_stretch_lut(dtype) -> np.ndarray:
+    """8/16 位元整數影像的拉伸查找表 (以 uint8/uint16 檢視索引)，其他型別回傳 None"""
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu" or dtype.itemsize > 2:
+        return None
+    lut = ortho_cache["stretch_lut"]
+    if lut is not None and lut[0] == dtype:
+        return lut[1]
 
+    stats = get_ortho_radiometry()
+    codes = np.arange(2 ** (8 * dtype.itemsize), dtype=np.uint32).astype(f"u{dtype.itemsize}").view(dtype)
+    table = stretch_values(codes, stats["low"], stats["high"])
+    ortho_cache["stretch_lut"] = (dtype, table)
+    return table
 
-def load_ortho_image(tiff_path):
-    import rasterio
-    src = rasterio.open(tiff_path)
-    ortho_cache["src"] = src
-    ortho_cache["transform"] = src.transform
-    ortho_cache["crs"] = src.crs
-    ortho_cache["width"] = src.width
-    ortho_cache["height"] = src.height
-    ortho_cache["pixel_w"], ortho_cache["pixel_h"] = src.res
 
-    bounds = src.bounds
-    try:
-        from pyproj import Transformer
-        transformer = Transformer.from_crs(src.crs, "EPSG:4326", always_xy=True)
-        west, south = transformer.transform(bounds.left, bounds.bottom)
-        east, north = transformer.transform(bounds.right, bounds.top)
-        ortho_cache["bounds"] = {"north": north, "south": south, "east": east, "west": west}
-    except:
-        ortho_cache["bounds"] = {"north": bounds.top, "south": bounds.bottom, "east": bounds.right, "west": bounds.left}
+def stretch_values(values: np.ndarray, low: float, high: float) -> np.ndarray:
+    """依 [low, high] 線性拉伸並截斷為 uint8"""
+    out = (values.astype(np.float32) - low) * (255 / max(high - low, 1e-6))
+    return np.clip(np.nan_to_num(out), 0, 255).astype(np.uint8)
 
-    print(f"[Ortho] Loaded: {src.width}x{src.height}")
 
+def ortho_to_uint8(img: np.ndarray) -> np.ndarray:
+    """非 uint8 影像依匯入時的百分位拉伸參數轉為 uint8 (整數型別查表，浮點數線性轉換)"""
+    if img.dtype == np.uint8:
+        return img
+    lut = get_stretch_lut(img.dtype)
+    if lut is not None:
+        return lut[img.view(f"u{img.dtype.itemsize}")]
+    stats = get_ortho_radiometry()
+    return stretch_values(img, stats["low"], stats["high"])
 
-def load_point_cloud(laz_path):
-    import laspy
-    las = laspy.read(laz_path)
-    pointcloud_cache["X"] = np.asarray(las.x)
-    pointcloud_cache["Y"] = np.asarray(las.y)
-    pointcloud_cache["Z"] = np.asarray(las.z)
-    pointcloud_cache["loaded"] = True
-    print(f"[PointCloud] Loaded {len(pointcloud_cache['Z'])} points")
 
+def read_landcover_rows(y0: int, y1: int, pad_h: int, pad_w: int, img: np.ndarray = None) -> np.ndarray:
+    """讀取補邊後影像的第 [y0, y1) 列 (uint8, HWC)
 
-def load_dsm(dsm_path):
-    """載入 DSM GeoTIFF"""
-    import rasterio
-    src = rasterio.open(dsm_path)
-    dsm_cache["data"] = src.read(1)  # 讀取第一個 band
-    dsm_cache["transform"] = src.transform
-    dsm_cache["crs"] = src.crs
-    dsm_cache["nodata"] = src.nodata
-    dsm_cache["loaded"] = True
-    dsm_cache["resolution"] = src.res[0]  # 假設正方形像素
-    print(f"[DSM] Loaded: {src.width}x{src.height}, resolution={src.res[0]}m")
-    src.close()
+    補邊為下方 pad_h 列與右方 pad_w 行的 BORDER_REFLECT_101，與整張影像補邊結果相同：
+    需要下方反射時會多讀取足夠的上方列，再裁掉。
 
+    Args:
+        img: 已在記憶體中的 (降採樣) 影像；None 時從正射影像以視窗讀取
+    """
+    import cv2
+    from rasterio.windows import Window
 
-def compute_terrain_analysis():
-    """計算坡度和坡向"""
-    if not dsm_cache["loaded"]:
-        return None
+    if img is not None:
+        H, W = img.shape[:2]
+    else:
+        H, W = ortho_cache["height"], ortho_cache["width"]
+    pad_bottom = max(0, y1 - H)
+    start = min(y0, max(0, H - 1 - pad_bottom))
 
-    dem = dsm_cache["data"]
-    res = dsm_cache["resolution"]
-    nodata = dsm_cache["nodata"]
+    if img is not None:
+        rows = img[start:min(y1, H)]
+    else:
+        data = ortho_reader().read([1, 2, 3], window=Window(0, start, W, min(y1, H) - start))
+        rows = ortho_to_uint8(np.moveaxis(data, 0, -1))
 
-    # 處理 nodata
-    if nodata is not None:
-        dem = np.where(dem == nodata, np.nan, dem)
+    rows = cv2.copyMakeBorder(rows, 0, pad_bottom, 0, pad_w, cv2.BORDER_REFLECT_101)
+    return rows[y0 - start:]
 
-    # 計算梯度 (使用 numpy gradient)
-    dy, dx = np.gradient(dem, res)
 
-    # 坡度 (degrees)
-    slope_rad = np.arctan(np.sqrt(dx**2 + dy**2))
-    slope_deg = np.degrees(slope_rad)
+def read_ortho_decimated(scale: float) -> np.ndarray:
+    """以平均重採樣讀取縮小 scale 倍的正射影像 (uint8, HWC)，有 overview 時 GDAL 會直接使用"""
+    from rasterio.enums import Resampling
 
-    # 坡向 (degrees, 0=North, 90=East, 180=South, 270=West)
-    aspect_rad = np.arctan2(-dx, dy)
-    aspect_deg = np.degrees(aspect_rad)
-    aspect_deg = np.where(aspect_deg < 0, aspect_deg + 360, aspect_deg)
+    src = ortho_reader()
+    out_h = max(1, int(round(src.height / scale)))
+    out_w = max(1, int(round(src.width / scale)))
+    data = src.read([1, 2, 3], out_shape=(3, out_h, out_w), resampling=Resampling.average)
+    return ortho_to_uint8(np.moveaxis(data, 0, -1))
 
-    return {
-        "slope": slope_deg,
-        "aspect": aspect_deg,
-        "stats": {
-            "slope_mean": float(np.nanmean(slope_deg)),
-            "slope_max": float(np.nanmax(slope_deg)),
-            "slope_min": float(np.nanmin(slope_deg)),
-        }
-    }
 
+def remove_landcover_mask():
+    """刪除磁碟上的土地覆蓋遮罩檔"""
+    path = landcover_cache.get("mask_path")
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"[UPerNet] Failed to delete {path}: {e}")
 
-def get_slope_colorized():
-    """取得彩色坡度圖 (terrain colormap)"""
-    if not dsm_cache["loaded"]:
-        return None
 
-    terrain = compute_terrain_analysis()
-    if terrain is None:
-        return None
+def run_landcover_segmentation(progress_callback=None, workers: int = None, tile_size: int = None,
+                               batch_size: int = None, gsd: float = None) -> dict:
+    """執行土地覆蓋分割 (逐列區塊串流處理)
 
-    slope = terrain["slope"]
+    影像依列分成區塊，每個區塊連同上下 halo (覆蓋該區塊的所有切片) 一起讀取並推論，
+    只保留區塊本身的 argmax 結果寫入磁碟上的 uint8 memmap，記憶體用量與影像高度無關。
 
-    # Normalize slope to 0-1 (cap at 60 degrees)
-    slope_norm = np.clip(slope / 60.0, 0, 1)
+    Args:
+        tile_size: 切片邊長 (像素，會調整為 32 的倍數)，預設 UPERNET_CONFIG["tile_size"]
+        batch_size: 每次推論的切片數，預設 UPERNET_CONFIG["batch_size"]
+        gsd: 分割使用的地面解析度 (公尺)；大於原始 GSD 時先降採樣讀取，
+             推論完再以最近鄰放大回正射影像網格。預設 UPERNET_CONFIG["target_gsd"]
+    """
+    if ortho_cache["src"] is None:
+        raise ValueError("No ortho image loaded")
 
-    # Use a terrain-like colormap (green -> yellow -> brown -> white)
-    # Create RGB image
-    H, W = slope.shape
-    colored = np.zeros((H, W, 3), dtype=np.uint8)
+    model = load_upernet_model()
+    if model is None:
+        raise ValueError("Failed to load UPerNet model")
 
-    # Green (flat) -> Yellow -> Orange -> Red -> Brown (steep)
-    colored[:, :, 0] = np.clip(slope_norm * 2 * 255, 0, 255).astype(np.uint8)  # R
-    colored[:, :, 1] = np.clip((1 - slope_norm) * 255, 0, 255).astype(np.uint8)  # G
-    colored[:, :, 2] = np.clip((1 - slope_norm * 2) * 128, 0, 128).astype(np.uint8)  # B
+    device = upernet_cache["device"]
+    full_h, full_w = ortho_cache["height"], ortho_cache["width"]
+
+    # 多解析度：目標 GSD 較粗時在降採樣影像上推論
+    native_gsd = min(abs(ortho_cache["pixel_w"]), abs(ortho_cache["pixel_h"]))
+    gsd = gsd or UPERNET_CONFIG["target_gsd"]
+    scale = max(1.0, gsd / native_gsd) if gsd and native_gsd > 0 else 1.0
+    img_lowres = read_ortho_decimated(scale) if scale > 1 else None
+    H, W = img_lowres.shape[:2] if img_lowres is not None else (full_h, full_w)
+    sy, sx = full_h / H, full_w / W
+    th, tw = (tile_size, tile_size) if tile_size else UPERNET_CONFIG["tile_size"]
+    th, tw = max(32, -(-th // 32) * 32), max(32, -(-tw // 32) * 32)
+    overlap = UPERNET_CONFIG["overlap"]
+    num_classes = UPERNET_CONFIG["num_classes"]
 
-    # Handle NaN as black
-    nan_mask = np.isnan(slope)
-    colored[nan_mask] = [0, 0, 0]
+    stride_h = max(1, int(th * (1 - overlap)))
+    stride_w = max(1, int(tw * (1 - overlap)))
+
+    # Padding
+    pad_h = max(((H - th) // stride_h + 1) * stride_h + th - H, 0)
+    pad_w = max(((W - tw) // stride_w + 1) * stride_w + tw - W, 0)
+    Hp, Wp = H + pad_h, W + pad_w
+
+    # 空白切片預篩
+    ys = np.arange(0, Hp - th + 1, stride_h)
+    xs = np.arange(0, Wp - tw + 1, stride_w)
+    gx, gy = np.meshgrid(xs, ys)
+    tile_valid = tiles_have_data(gx.ravel() * sx, gy.ravel() * sy, int(np.ceil(tw * sx)),
+                                 int(np.ceil(th * sy))).reshape(gy.shape)
+    skipped = int((~tile_valid).sum())
+
+    # 區塊高度：logits + 權重累加陣列 (num_classes + 1 個 float32) 不超過 block_memory_mb
+    block_rows = UPERNET_CONFIG["block_memory_mb"] * 1024 ** 2 // (Wp * (num_classes + 1) * 4)
+    block_rows = max(stride_h, block_rows // stride_h * stride_h)
+    print(f"[UPerNet] {tile_valid.size} tiles of {th}x{tw} at {native_gsd * scale:.3f} m ({W}x{H}), "
+          f"{skipped} empty skipped, block_rows={block_rows}")
+
+    LANDCOVER_DIR.mkdir(parents=True, exist_ok=True)
+    mask_path = LANDCOVER_DIR / f"landcover_{int(time.time() * 1000)}.npy"
+    mask = np.lib.format.open_memmap(str(mask_path), mode="w+", dtype=np.uint8, shape=(full_h, full_w))
+    out = np.zeros((H, W), np.uint8) if img_lowres is not None else mask
+    class_counts = np.zeros(256, np.int64)
+
+    n_workers = resolve_worker_count(workers)
+    pool = None
+
+    try:
+        pool = create_worker_pool(n_workers) if n_workers > 1 else None
+        for r0 in range(0, H, block_rows):
+            r1 = min(r0 + block_rows, H)
+
+            # 覆蓋 [r0, r1) 的切片列與對應的補邊影像範圍 (含 halo)
+            rows_idx = np.nonzero((ys < r1) & (ys + th > r0))[0]
+            y0, y1 = int(ys[rows_idx[0]]), int(ys[rows_idx[-1]]) + th
+            band = read_landcover_rows(y0, y1, pad_h, pad_w, img_lowres)
+            band_valid = tile_valid[rows_idx]
+
+            def report(tile_count, total_tiles, r0=r0, r1=r1):
+                if progress_callback:
+                    progress = int((r0 + (r1 - r0) * tile_count / max(total_tiles, 1)) / H * 100)
+                    progress_callback(progress, f"Landcover segmentation (rows {r0}-{r1}/{H})...")
+
+            # Sliding window inference
+            if pool is not None:
+                logit_sum, count = accumulate_landcover_parallel(pool, band, (th, tw), (stride_h, stride_w), report,
+                                                                 tile_valid=band_valid, batch_size=batch_size)
+            else:
+                logit_sum, count = accumulate_landcover_band(model, device, band, (th, tw), (stride_h, stride_w),
+                                                             report, tile_valid=band_valid, batch_size=batch_size)
+
+            # Get prediction
+            core = slice(r0 - y0, r1 - y0)
+            count = count[core, :W]
+            pred = np.argmax(logit_sum[:, core, :W] / np.maximum(count, 1e-6), axis=0).astype(np.uint8)
+            pred[count == 0] = 255  # 略過的空白切片
+
+            # Handle nodata (black pixels)
+            black_mask = np.all(band[core, :W] <= 10, axis=2)
+            pred[black_mask] = 255
+
+            out[r0:r1] = pred
+            if img_lowres is None:
+                class_counts += np.bincount(pred.ravel(), minlength=256)
+    except BaseException:
+        # 取消或失敗時捨棄尚未開始的切片並移除未完成的遮罩檔
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+            pool = None
+        mask_path.unlink(missing_ok=True)
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # 降採樣結果以最近鄰放大回正射影像網格 (逐列區塊寫入)
+    if img_lowres is not None:
+        cols = np.minimum(((np.arange(full_w) + 0.5) / sx).astype(np.int64), W - 1)
+        for r0 in range(0, full_h, 1024):
+            r1 = min(r0 + 1024, full_h)
+            rows = np.minimum(((np.arange(r0, r1) + 0.5) / sy).astype(np.int64), H - 1)
+            pred = out[rows][:, cols]
+            mask[r0:r1] = pred
+            class_counts += np.bincount(pred.ravel(), minlength=256)
+
+    mask.flush()
+    del mask
+
+    # Compute statistics
+    stats = {}
+    total_valid = class_counts[:num_classes].sum()
+    for class_id, class_name in LANDCOVER_CLASSES.items():
+        class_pixels = class_counts[class_id]
+        stats[class_name] = {
+            "pixels": int(class_pixels),
+            "percentage": round(class_pixels / total_valid * 100, 2) if total_valid > 0 else 0
+        }
+
+    # Cache results (遮罩以唯讀 memmap 引用磁碟檔案)
+    remove_landcover_mask()
+    landcover_cache["mask"] = np.load(str(mask_path), mmap_mode="r")
+    landcover_cache["mask_path"] = str(mask_path)
+    landcover_cache["stats"] = stats
+    landcover_cache["computed"] = True
+    landcover_cache["skipped_tiles"] = skipped
+    bump_data_version("landcover")
+    landcover_cache["resolution"] = {
+        "native_gsd": round(native_gsd, 4),
+        "gsd": round(native_gsd * scale, 4),
+        "scale": round(scale, 2),
+        "processed_shape": (H, W),
+        "pixel_fraction": round(H * W / (full_h * full_w), 4),  # 推論像素比例，約為耗時比例
+    }
+
+    print(f"[UPerNet] Segmentation complete: {full_h}x{full_w} -> {mask_path}")
+    return {"stats": stats, "shape": (full_h, full_w), "skipped_tiles": skipped,
+            "resolution": landcover_cache["resolution"]}
+
+
+# ============================================
+# 多行程平行推論
+# ============================================
+_worker_state = {"src": None}
+
+
+def resolve_worker_count(workers: int = None) -> int:
+    """決定平行 worker 數 (0 / 1 = 單一行程；有 GPU 時一律使用單一行程)"""
+    if workers is None:
+        workers = PARALLEL_CONFIG["workers"]
+    if not workers:
+        return 0
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return 0
+    except ImportError:
+        pass
+    cpu_count = os.cpu_count() or 1
+    if workers < 0:
+        return cpu_count
+    return min(workers, cpu_count)
+
+
+def create_worker_pool(n_workers: int):
+    """建立 spawn 行程池，每個 worker 開啟自己的正射影像 handle 並平分 torch 執行緒"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    torch_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_tile_worker,
+        initargs=(ortho_cache["src"].name, torch_threads),
+    )
+
+
+def _init_tile_worker(ortho_path: str, torch_threads: int):
+    import rasterio
+    import torch
+
+    torch.set_num_threads(torch_threads)
+    _worker_state["src"] = rasterio.open(ortho_path)
+
+
+def _yolo_worker_chunk(classes: list[str], windows: list[tuple], patch_size: int, batch_size: int) -> dict:
+    """worker：對一組視窗執行 YOLO，回傳 {cls: (boxes, scores)} (已加上視窗偏移)"""
+    models = load_yolo_models()
+    src = _worker_state["src"]
+    raw = DetectionBuffer()
+
+    for i in range(0, len(windows), batch_size):
+        batch = [(x, y, read_ortho_patch(src, x, y, patch_size)) for x, y in windows[i:i + batch_size]]
+        for cls_name in classes:
+            run_yolo_batch(models[cls_name], cls_name, batch, raw)
+
+    return {cls_name: raw.get(cls_name) for cls_name in classes}
+
+
+def run_yolo_pass_parallel(classes: list[str], windows: list[tuple], patch_size: int, batch_size: int,
+                           n_workers: int, raw: DetectionBuffer, report=None):
+    """將切片分組交給行程池，依原順序合併回 raw"""
+    from concurrent.futures import as_completed
+
+    chunk = PARALLEL_CONFIG["chunk_tiles"]
+    chunks = [windows[i:i + chunk] for i in range(0, len(windows), chunk)]
+    results = [None] * len(chunks)
+    done = 0
+
+    pool = create_worker_pool(n_workers)
+    try:
+        futures = {pool.submit(_yolo_worker_chunk, classes, c, patch_size, batch_size): i
+                   for i, c in enumerate(chunks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            done += len(chunks[i])
+            if report:
+                report(done)
+    except BaseException:
+        # 取消或失敗時捨棄尚未開始的分組，只等待執行中的分組
+        pool.shutdown(cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    for result in results:
+        for cls_name, (boxes, scores) in result.items():
+            raw.add(cls_name, boxes, scores)
+
+
+def _landcover_worker_band(band: np.ndarray, tile_size: tuple, strides: tuple, tile_valid: np.ndarray = None,
+                           batch_size: int = None) -> tuple:
+    """worker：對一段已補邊影像執行 UPerNet 滑動視窗，回傳 (logit_sum, weight_sum)"""
+    model = load_upernet_model()
+    return accumulate_landcover_band(model, upernet_cache["device"], band, tile_size, strides,
+                                     tile_valid=tile_valid, batch_size=batch_size)
+
+
+# ============================================
+# 查表著色 (256 色調色盤，索引 255 保留給 nodata)
+# ============================================
+NODATA_INDEX = 255
+
+
+def ramp_palette(fn) -> np.ndarray:
+    """由 t (0-1) -> (r, g, b) 0-1 的函式建立調色盤，索引 0-254 對應 t = 0-1"""
+    t = np.arange(NODATA_INDEX) / (NODATA_INDEX - 1)
+    palette = np.zeros((256, 3), np.uint8)
+    palette[:NODATA_INDEX] = (np.clip(np.stack(fn(t), axis=-1), 0, 1) * 255).astype(np.uint8)
+    return palette
+
+
+def aspect_palette() -> np.ndarray:
+    """坡向調色盤 (方位角為色相，HSV s=0.8, v=0.9)"""
+    import colorsys
+    palette = np.zeros((256, 3), np.uint8)
+    for i in range(NODATA_INDEX):
+        palette[i] = [int(c * 255) for c in colorsys.hsv_to_rgb(i / (NODATA_INDEX - 1), 0.8, 0.9)]
+    return palette
+
+
+def class_palette(classes: dict, colors: dict) -> np.ndarray:
+    """類別遮罩調色盤 (索引 = 類別 ID，未定義類別與 nodata 為黑)"""
+    palette = np.zeros((256, 3), np.uint8)
+    for class_id, class_name in classes.items():
+        palette[class_id] = colors[class_name]
+    return palette
+
+
+COLOR_PALETTES = {
+    # 綠 (平坦) -> 黃 -> 紅 (陡)
+    "slope": ramp_palette(lambda t: (t * 2, 1 - t, (1 - t * 2) * 0.5)),
+    "aspect": aspect_palette(),
+    # 藍 (低) -> 綠 -> 紅 (高)
+    "ndsm": ramp_palette(lambda t: (t * 2 - 1, 1 - np.abs(t * 2 - 1), 1 - t * 2)),
+    "landcover": class_palette(LANDCOVER_CLASSES, LANDCOVER_COLORS),
+}
+
+
+def quantize_to_index(values: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+    """將數值線性量化為調色盤索引 0-254，NaN 為 NODATA_INDEX"""
+    scale = (NODATA_INDEX - 1) / max(vmax - vmin, 1e-12)
+    nan_mask = np.isnan(values)
+    idx = np.clip((np.where(nan_mask, vmin, values) - vmin) * scale + 0.5, 0, NODATA_INDEX - 1).astype(np.uint8)
+    idx[nan_mask] = NODATA_INDEX
+    return idx
+
+
+def apply_palette(index: np.ndarray, name: str) -> np.ndarray:
+    """以調色盤查表，一次 gather 產生 RGB 影像"""
+    return COLOR_PALETTES[name][index]
+
+
+def display_shape(height: int, width: int, max_width: int = None):
+    """依顯示寬度計算輸出大小，不放大"""
+    if not max_width or max_width >= width:
+        return height, width
+    return max(1, int(height * max_width / width)), max_width
+
+
+def get_landcover_colorized(max_width: int = None) -> np.ndarray:
+    """取得彩色土地覆蓋圖
+
+    Args:
+        max_width: 顯示寬度；較小時先以最近鄰取樣遮罩再著色
+    """
+    if not landcover_cache["computed"] or landcover_cache["mask"] is None:
+        return None
+
+    mask = landcover_cache["mask"]
+    mask = sample_nearest(mask, *display_shape(*mask.shape, max_width))
+    return apply_palette(mask, "landcover")
+
+
+def sample_nearest(array: np.ndarray, h: int, w: int) -> np.ndarray:
+    """以最近鄰取樣將 2D 陣列縮為 (h, w)，大小相同時直接回傳"""
+    H, W = array.shape[:2]
+    if (h, w) == (H, W):
+        return np.asarray(array)
+    rows = ((np.arange(h) + 0.5) * H / h).astype(np.int64)
+    cols = ((np.arange(w) + 0.5) * W / w).astype(np.int64)
+    return np.asarray(array[rows][:, cols])
+
+
+def read_ortho_rgb(out_shape=None) -> np.ndarray:
+    """讀取正射影像 RGB (HWC，原始 dtype)；out_shape 指定時以平均重採樣降採樣讀取，有 overview 時直接使用"""
+    from rasterio.enums import Resampling
+    src = ortho_reader()
+    if out_shape is None or tuple(out_shape) == (src.height, src.width):
+        return np.moveaxis(src.read([1, 2, 3]), 0, -1)
+    data = src.read([1, 2, 3], out_shape=(3,) + tuple(out_shape), resampling=Resampling.average)
+    return np.moveaxis(data, 0, -1)
+
+
+def sample_trunc_normal(mean, std, low, high, size: int = None):
+    """截斷常態分布抽樣 (向量化拒絕抽樣，最多 60 輪，剩餘者改用均勻分布)"""
+    n = 1 if size is None else size
+    out = np.empty(n)
+    pending = np.arange(n)
+    for _ in range(60):
+        if len(pending) == 0:
+            break
+        v = rng.normal(mean, std, len(pending))
+        ok = (v >= low) & (v <= high)
+        out[pending[ok]] = v[ok]
+        pending = pending[~ok]
+    out[pending] = rng.uniform(low, high, len(pending))
+    return float(out[0]) if size is None else out
+
+
+def impute_height_by_class(cls_name, h_raw, n_pts, min_pts):
+    """依類別先驗補值：點數不足、無效或超出 HEIGHT_RANGE 的高度改為截斷常態抽樣
+
+    Args:
+        h_raw, n_pts: 同類別所有物件的原始高度與點數 (陣列)
+
+    Returns:
+        (heights, imputed)：補值後高度與是否為補值的布林陣列
+    """
+    hmin, hmax = HEIGHT_RANGE.get(cls_name, (0.0, float('inf')))
+    prior = HEIGHT_PRIOR.get(cls_name, {"mean": (hmin + hmax) / 2.0, "std": 0.1})
+
+    h = np.asarray(h_raw, dtype=np.float64)
+    n_pts = np.asarray(n_pts)
+    with np.errstate(invalid="ignore"):
+        imputed = (n_pts == 0) | (n_pts < min_pts) | ~np.isfinite(h) | (h < hmin) | (h > hmax)
+    h = np.where(imputed, 0.0, h)
+    h[imputed] = sample_trunc_normal(prior["mean"], prior["std"], hmin, hmax, int(imputed.sum()))
+    return h, imputed
+
+
+def gather_grid_windows(grid: dict, layers: list, minx, miny, maxx, maxy) -> tuple:
+    """一次取出多個範圍內的格網值
+
+    Returns:
+        (seg, values)：seg 為每個值所屬的範圍編號 (遞增)，values 為各圖層的格網值
+    """
+    ox, oy, _ = pointcloud_cache["origin"]
+    res, (height, width) = grid["res"], grid["shape"]
+    c0 = np.clip(np.floor((minx - ox - grid["x0"]) / res).astype(np.int64), 0, width)
+    c1 = np.clip(np.floor((maxx - ox - grid["x0"]) / res).astype(np.int64) + 1, 0, width)
+    r0 = np.clip(np.floor((grid["y1"] - (maxy - oy)) / res).astype(np.int64), 0, height)
+    r1 = np.clip(np.floor((grid["y1"] - (miny - oy)) / res).astype(np.int64) + 1, 0, height)
+
+    # 每個範圍的每一列是一段連續的格網索引：先展開列，再展開列內的欄
+    w = np.maximum(c1 - c0, 0)
+    h = np.maximum(r1 - r0, 0)
+    run_seg = np.repeat(np.arange(len(h)), h)
+    run_row = r0[run_seg] + np.arange(len(run_seg)) - np.repeat(np.cumsum(h) - h, h)
+    run_len = w[run_seg]
+    run_start = run_row * width + c0[run_seg]
+
+    seg = np.repeat(run_seg, run_len)
+    flat = np.repeat(run_start - (np.cumsum(run_len) - run_len), run_len) + np.arange(len(seg))
+    return seg, [np.asarray(grid[layer]).reshape(-1)[flat] for layer in layers]
+
+
+def segment_percentile(seg: np.ndarray, values: np.ndarray, n_seg: int, q: float) -> np.ndarray:
+    """各分段第 q 百分位，空分段為 NaN
+
+    seg 須遞增。值平移到 [0, span) 後加上 seg * span 合成單一排序鍵，
+    一次 np.sort 即完成「先分段、再依值」的排序，比 lexsort 快數倍。
+    """
+    counts = np.bincount(seg, minlength=n_seg)
+    out = np.full(n_seg, np.nan)
+    if len(values) == 0:
+        return out
+
+    vmin = float(values.min())
+    span = float(values.max()) - vmin + 1.0
+    key = np.sort(seg * span + (values - vmin))
+    sorted_values = key - seg * span + vmin
+
+    starts = np.zeros(n_seg, np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    has = counts > 0
+    out[has] = grouped_percentile(sorted_values, starts[has], counts[has], q)
+    return out
+
+
+def compute_height_volume(detections, progress_callback=None):
+    """批次估算物件高度：同類別的所有偵測框一次完成格網視窗統計與補值"""
+    if not detections:
+        return detections
+
+    cls_of = np.array([det["cls"] if det["cls"] != "vehicle" else "car" for det in detections])
+    heights = np.zeros(len(detections))
+    elev = np.full(len(detections), np.nan)
+
+    if pointcloud_cache["loaded"]:
+        transform = ortho_cache["transform"]
+        px = np.array([[det["px1"], det["px2"]] for det in detections], dtype=np.float64)
+        py = np.array([[det["py1"], det["py2"]] for det in detections], dtype=np.float64)
+        wx, wy = transform * (px, py)
+        minx, maxx = wx.min(axis=1), wx.max(axis=1)
+        miny, maxy = wy.min(axis=1), wy.max(axis=1)
+        Z = pointcloud_cache["Z"]
+        oz = pointcloud_cache["origin"][2]
+        grids = pointcloud_cache["grids"] or {}
+        cfg = HEIGHT_GRID_CONFIG
+
+    for cls in np.unique(cls_of):
+        idx = np.flatnonzero(cls_of == cls)
+        n = len(idx)
+        h_raw, n_pts = np.full(n, np.nan), np.zeros(n, np.int64)
+
+        if pointcloud_cache["loaded"]:
+            bounds = (minx[idx], miny[idx], maxx[idx], maxy[idx])
+            grid = grids.get(CELL_BY_CLASS.get(cls))
+            if grid is not None:
+                # 格網視窗統計：nDSM 高百分位為物件高，地面高中位數為高程
+                seg, (count, ndsm) = gather_grid_windows(grid, ["count", "ndsm"], *bounds)
+                n_pts = np.bincount(seg, weights=count, minlength=n).astype(np.int64)
+                valid = (count > 0) & np.isfinite(ndsm)
+                h_raw = segment_percentile(seg[valid], ndsm[valid], n, cfg["top_percentile"])
+
+                seg, (ground,) = gather_grid_windows(pointcloud_cache["ground"], ["z"], *bounds)
+                valid = np.isfinite(ground)
+                elev[idx] = segment_percentile(seg[valid], ground[valid], n, 50) + oz
+            else:
+                hits = [query_points_bbox(*b) for b in zip(*bounds)]
+                n_pts = np.array([len(m) for m in hits], np.int64)
+                seg = np.repeat(np.arange(n), n_pts)
+                zz = np.asarray(Z)[np.concatenate(hits)] if n_pts.sum() else np.empty(0, np.float32)
+                z0 = segment_percentile(seg, zz, n, cfg["low_percentile"])
+                h_raw = np.maximum(segment_percentile(seg, zz, n, cfg["top_percentile"]) - z0, 0)
+                elev[idx] = z0 + oz
+
+        heights[idx], _ = impute_height_by_class(cls, h_raw, n_pts, MIN_PTS_BY_CLASS.get(cls, 30))
+
+    for det, h, z in zip(detections, heights, elev):
+        det["height_m"] = round(float(h), 2)
+        if np.isfinite(z):
+            det["elev_z"] = round(float(z), 1)
+
+    return detections
+
+
+def add_latlon_to_detections(detections):
+    if ortho_cache["crs"] is None:
+        return detections
+    try:
+        from pyproj import Transformer
+        transformer = Transformer.from_crs(ortho_cache["crs"], "EPSG:4326", always_xy=True)
+        xs = np.array([det["center_x"] for det in detections], dtype=np.float64)
+        ys = np.array([det["center_y"] for det in detections], dtype=np.float64)
+        lons, lats = transformer.transform(xs, ys)
+        for det, lon, lat in zip(detections, lons, lats):
+            det["lat"] = round(float(lat), 6)
+            det["lon"] = round(float(lon), 6)
+    except Exception as e:
+        print(f"[Coord] Error: {e}")
+    return detections
+
+
+_thread_datasets = threading.local()
+
+
+def thread_dataset(kind: str, path: str):
+    """目前執行緒專用的 rasterio 資料集
+
+    GDAL handle 不可跨執行緒共用 (同 PrefetchTileReader)；ortho_cache / dsm_cache 的 src 只用於讀取中繼資料，
+    像素讀取一律經由此函式。每種資料只保留一個 handle，以 (路徑, data_versions[kind]) 判斷是否過期：
+    同名檔案重新上傳或轉為 COG 後，下次存取時關閉舊 handle 並重新開啟。
+    """
+    import rasterio
+
+    datasets = getattr(_thread_datasets, "datasets", None)
+    if datasets is None:
+        datasets = _thread_datasets.datasets = {}
+    key = (path, data_versions[kind])
+    cached = datasets.get(kind)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    if cached is not None:
+        try:
+            cached[1].close()
+        except Exception:
+            pass
+    src = rasterio.open(path)
+    datasets[kind] = (key, src)
+    return src
+
+
+def ortho_reader():
+    """目前執行緒的正射影像 handle"""
+    return thread_dataset("ortho", ortho_cache["src"].name)
+
+
+def dsm_reader():
+    """目前執行緒的 DSM handle"""
+    return thread_dataset("dsm", dsm_cache["path"])
+
+
+def load_ortho_image(tiff_path):
+    import rasterio
+    src = rasterio.open(tiff_path)
+    with cog_lock:
+        ortho_cache["src"] = src
+        ortho_cache["transform"] = src.transform
+        ortho_cache["crs"] = src.crs
+        ortho_cache["width"] = src.width
+        ortho_cache["height"] = src.height
+        ortho_cache["pixel_w"], ortho_cache["pixel_h"] = src.res
+        ortho_cache["valid_mask"] = None
+        ortho_cache["radiometry"] = None
+        ortho_cache["stretch_lut"] = None
+        bump_data_version("ortho")
+
+    bounds = src.bounds
+    try:
+        from pyproj import Transformer
+        transformer = Transformer.from_crs(src.crs, "EPSG:4326", always_xy=True)
+        west, south = transformer.transform(bounds.left, bounds.bottom)
+        east, north = transformer.transform(bounds.right, bounds.top)
+        ortho_cache["bounds"] = {"north": north, "south": south, "east": east, "west": west}
+    except:
+        ortho_cache["bounds"] = {"north": bounds.top, "south": bounds.bottom, "east": bounds.right, "west": bounds.left}
+
+    # 只有非 uint8 影像需要拉伸參數；uint8 影像於查詢統計時才計算
+    if src.dtypes[0] != "uint8":
+        try:
+            stats = get_ortho_radiometry()
+            print(f"[Ortho] Radiometry: {stats['dtype']} stretch {stats['low']:.1f}-{stats['high']:.1f}")
+        except Exception as e:
+            print(f"[Ortho] Radiometry failed: {e}")
+
+    print(f"[Ortho] Loaded: {src.width}x{src.height}")
+
+
+def build_point_index(X: np.ndarray, Y: np.ndarray, cell_size: float = None):
+    """建立點雲均勻網格索引
+
+    點依格網編號 (列優先) 排序，每格的點在排序後為連續區段，
+    starts[k]:starts[k+1] 即第 k 格的點。
+
+    Returns:
+        (order, index)：order 為排序後的點順序，index 為格網參數與 CSR 起始位置
+    """
+    x0, y0 = float(X.min()), float(Y.min())
+    span_x = max(float(X.max()) - x0, 1e-6)
+    span_y = max(float(Y.max()) - y0, 1e-6)
+
+    cfg = POINT_INDEX_CONFIG
+    cell = cell_size or cfg["cell_size"]
+    if not cell:
+        density = len(X) / (span_x * span_y)
+        cell = np.sqrt(cfg["points_per_cell"] / max(density, 1e-9))
+    cell = max(float(cell), cfg["min_cell"], np.sqrt(span_x * span_y / cfg["max_cells"]))
+
+    nx = int(span_x // cell) + 1
+    ny = int(span_y // cell) + 1
+    cx = ((X - x0) / cell).astype(np.int64)
+    cy = ((Y - y0) / cell).astype(np.int64)
+    cell_id = cy * nx + cx
+    del cx, cy
+
+    order = np.argsort(cell_id, kind="stable")
+    starts = np.zeros(nx * ny + 1, np.int64)
+    np.cumsum(np.bincount(cell_id, minlength=nx * ny), out=starts[1:])
+
+    index = {"origin": (x0, y0), "cell": cell, "nx": nx, "ny": ny, "starts": starts}
+    return order, index
+
+
+def query_points_bbox(minx: float, miny: float, maxx: float, maxy: float) -> np.ndarray:
+    """以網格索引取得落在範圍內的點索引 (對應 pointcloud_cache 的 X/Y/Z)
+
+    只檢查與範圍相交的格網，耗時與範圍內點數成正比，而非整體點數。
+    範圍為投影座標，內部轉為相對於點雲原點的區域座標。
+    """
+    idx = pointcloud_cache["index"]
+    X, Y = pointcloud_cache["X"], pointcloud_cache["Y"]
+    ox, oy, _ = pointcloud_cache["origin"]
+    minx, maxx, miny, maxy = minx - ox, maxx - ox, miny - oy, maxy - oy
+    x0, y0 = idx["origin"]
+    cell, nx, ny = idx["cell"], idx["nx"], idx["ny"]
+
+    cx0 = int(np.floor((minx - x0) / cell))
+    cx1 = int(np.floor((maxx - x0) / cell))
+    cy0 = int(np.floor((miny - y0) / cell))
+    cy1 = int(np.floor((maxy - y0) / cell))
+    if cx1 < 0 or cy1 < 0 or cx0 >= nx or cy0 >= ny:
+        return np.empty(0, np.int64)
+    cx0, cy0 = max(cx0, 0), max(cy0, 0)
+    cx1, cy1 = min(cx1, nx - 1), min(cy1, ny - 1)
+
+    # 每一格網列中相交的格子在排序後為一段連續區間
+    rows = np.arange(cy0, cy1 + 1) * nx
+    lo = idx["starts"][rows + cx0]
+    hi = idx["starts"][rows + cx1 + 1]
+    cand = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)])
+
+    xs, ys = X[cand], Y[cand]
+    return cand[(xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)]
+
+
+def file_sha256(path) -> str:
+    """計算檔案內容的 SHA-256"""
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pointcloud_store_key(content_hash: str, crop) -> str:
+    """點雲快取鍵：檔案內容雜湊 + 裁切範圍 + 索引參數"""
+    import hashlib
+    params = repr((content_hash, tuple(round(v, 3) for v in crop) if crop else None,
+                   POINT_INDEX_CONFIG["cell_size"], POINT_INDEX_CONFIG["points_per_cell"]))
+    return hashlib.sha256(params.encode()).hexdigest()[:32]
+
+
+def open_pointcloud_store(key: str) -> bool:
+    """以 memmap 開啟已轉換的點雲，命中時更新最近使用時間"""
+    import json
+    entry = POINTCLOUD_STORE_DIR / key
+    meta_path = entry / "meta.json"
+    if not meta_path.exists():
+        return False
+
+    try:
+        meta = json.loads(meta_path.read_text())
+        arrays = {name: np.load(str(entry / f"{name}.npy"), mmap_mode="r") for name in ("X", "Y", "Z", "starts")}
+    except Exception as e:
+        print(f"[PointCloud] Store entry {key} unreadable: {e}")
+        shutil.rmtree(entry, ignore_errors=True)
+        return False
+
+    index = dict(meta["index"], origin=tuple(meta["index"]["origin"]), starts=arrays["starts"])
+    pointcloud_cache.update({"X": arrays["X"], "Y": arrays["Y"], "Z": arrays["Z"], "index": index,
+                             "origin": tuple(meta["origin"]), "stats": meta["stats"], "loaded": True})
+    os.utime(meta_path)
+    return True
+
+
+def save_pointcloud_store(key: str, X, Y, Z, index: dict, origin, stats: dict):
+    """將點雲欄位與網格索引寫入快取 (先寫暫存目錄再改名，避免留下不完整項目)"""
+    import json
+    entry = POINTCLOUD_STORE_DIR / key
+    tmp = POINTCLOUD_STORE_DIR / f".{key}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    for name, arr in (("X", X), ("Y", Y), ("Z", Z), ("starts", index["starts"])):
+        np.save(str(tmp / f"{name}.npy"), arr)
+    meta = {
+        "origin": list(origin),
+        "index": {k: v for k, v in index.items() if k != "starts"},
+        "stats": stats,
+        "created": datetime.now().isoformat(),
+    }
+    (tmp / "meta.json").write_text(json.dumps(meta, default=float))
+
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp, entry)
+    evict_pointcloud_store(keep=key)
+
+
+def evict_pointcloud_store(keep: str = None):
+    """超過 store_budget_gb 時，依最近使用時間刪除最舊的點雲快取"""
+    budget = POINTCLOUD_CONFIG["store_budget_gb"] * 1024 ** 3
+    entries = []
+    for entry in POINTCLOUD_STORE_DIR.iterdir():
+        meta_path = entry / "meta.json"
+        if not meta_path.exists():
+            continue
+        size = sum(f.stat().st_size for f in entry.iterdir())
+        entries.append((meta_path.stat().st_mtime, entry, size))
+
+    total = sum(size for _, _, size in entries)
+    for _, entry, size in sorted(entries):
+        if total <= budget:
+            break
+        if entry.name == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        print(f"[PointCloud] Evicted store entry {entry.name} ({size / 1024 ** 2:.0f} MB)")
+
+
+def load_point_cloud(laz_path, content_hash: str = None):
+    """分塊串流載入 LAZ 點雲
+
+    以 laspy chunk_iterator 逐塊解壓，已載入正射影像時只保留其範圍 (加 crop_margin) 內的點。
+    座標存為相對於區域原點的 float32 偏移 (pointcloud_cache["origin"])，
+    記憶體約為 float64 全量載入的 1/2，加上裁切後通常更少。
+
+    轉換結果 (欄位 + 網格索引) 依內容雜湊存於 POINTCLOUD_STORE_DIR，
+    相同檔案與裁切範圍再次載入時直接以 memmap 開啟，不需重新解壓。
+
+    Args:
+        content_hash: 檔案 SHA-256，已知時可省去重新計算
+    """
+    import laspy
+
+    bump_data_version("pointcloud")
+    cfg = POINTCLOUD_CONFIG
+    crop = None
+    if ortho_cache["src"] is not None:
+        b = ortho_cache["src"].bounds
+        m = cfg["crop_margin"]
+        crop = (b.left - m, b.bottom - m, b.right + m, b.top + m)
+
+    t0 = time.time()
+    key = pointcloud_store_key(content_hash or file_sha256(laz_path), crop)
+    if open_pointcloud_store(key):
+        print(f"[PointCloud] Opened store {key}: {len(pointcloud_cache['Z'])} points ({time.time() - t0:.1f}s)")
+        load_height_grids(key)
+        return
+
+    xs, ys, zs = [], [], []
+    total = 0
+    with laspy.open(laz_path) as reader:
+        mins = reader.header.mins
+        origin = (crop[0], crop[1], float(mins[2])) if crop else tuple(float(v) for v in mins)
+        for pts in reader.chunk_iterator(cfg["chunk_size"]):
+            x, y = np.asarray(pts.x), np.asarray(pts.y)
+            total += len(x)
+            if crop:
+                keep = (x >= crop[0]) & (x <= crop[2]) & (y >= crop[1]) & (y <= crop[3])
+                x, y, z = x[keep], y[keep], np.asarray(pts.z)[keep]
+            else:
+                z = np.asarray(pts.z)
+            xs.append((x - origin[0]).astype(np.float32))
+            ys.append((y - origin[1]).astype(np.float32))
+            zs.append((z - origin[2]).astype(np.float32))
+            del pts, x, y, z
+
+    X, Y, Z = np.concatenate(xs), np.concatenate(ys), np.concatenate(zs)
+    del xs, ys, zs
+    pointcloud_cache["stats"] = {"points_total": total, "points_kept": len(Z), "points_dropped": total - len(Z),
+                                 "cropped": crop is not None, "memory_mb": 0.0}
+    if len(Z) == 0:
+        pointcloud_cache.update({"X": None, "Y": None, "Z": None, "index": None, "origin": None,
+                                 "grids": None, "ground": None, "loaded": False})
+        print(f"[PointCloud] No points inside the ortho extent ({total} dropped)")
+        return
+
+    # 依網格排序後存放，範圍查詢只需讀取相交格網的連續區段
+    order, index = build_point_index(X, Y)
+    X, Y, Z = X[order], Y[order], Z[order]
+    del order
+
+    memory_mb = (X.nbytes + Y.nbytes + Z.nbytes + index["starts"].nbytes) / 1024 ** 2
+    pointcloud_cache["stats"]["memory_mb"] = round(memory_mb, 1)
+    try:
+        save_pointcloud_store(key, X, Y, Z, index, origin, pointcloud_cache["stats"])
+    except Exception as e:
+        print(f"[PointCloud] Failed to write store entry: {e}")
+    # 寫入成功時改用 memmap，記憶體交給 page cache 管理
+    if not open_pointcloud_store(key):
+        pointcloud_cache.update({"X": X, "Y": Y, "Z": Z, "index": index, "origin": origin, "loaded": True})
+    del X, Y, Z
+    load_height_grids(key)
+    kept = pointcloud_cache["stats"]["points_kept"]
+    print(f"[PointCloud] Loaded {kept}/{total} points ({total - kept} outside ortho), "
+          f"{memory_mb:.1f} MB, grid {index['nx']}x{index['ny']} @ {index['cell']:.2f} m "
+          f"({time.time() - t0:.1f}s)")
+
+
+def grouped_percentile(values: np.ndarray, starts: np.ndarray, counts: np.ndarray, q: float) -> np.ndarray:
+    """對已依群組、再依值排序的陣列計算各群組第 q 百分位 (線性內插，同 np.percentile)
+
+    Args:
+        starts, counts: 各群組在 values 中的起點與長度 (counts 須 > 0)
+    """
+    pos = starts + (counts - 1) * (q / 100.0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, starts + counts - 1)
+    frac = (pos - lo).astype(np.float32)
+    return values[lo] * (1 - frac) + values[hi] * frac
+
+
+def grid_geometry(X: np.ndarray, Y: np.ndarray, res: float) -> dict:
+    """以點雲範圍建立北朝上的格網 (區域座標，第 0 列在最北)"""
+    x0, y1 = float(X.min()), float(Y.max())
+    width = int((float(X.max()) - x0) / res) + 1
+    height = int((y1 - float(Y.min())) / res) + 1
+    return {"res": res, "x0": x0, "y1": y1, "shape": (height, width)}
+
+
+def grid_cells(grid: dict, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+    """點所在格網的一維編號"""
+    res, (height, width) = grid["res"], grid["shape"]
+    col = np.minimum(((X - grid["x0"]) / res).astype(np.int64), width - 1)
+    row = np.minimum(((grid["y1"] - Y) / res).astype(np.int64), height - 1)
+    return row * width + col
+
+
+def grid_transform(grid: dict):
+    """格網的仿射轉換 (投影座標)"""
+    from rasterio.transform import from_origin
+    ox, oy, _ = pointcloud_cache["origin"]
+    return from_origin(ox + grid["x0"], oy + grid["y1"], grid["res"], grid["res"])
+
+
+def bin_point_grid(grid: dict, X, Y, Z, percentiles) -> tuple:
+    """將點分箱至格網，回傳 (count, {q: 各格第 q 百分位 Z})，空格為 NaN"""
+    height, width = grid["shape"]
+    cells = grid_cells(grid, X, Y)
+    order = np.lexsort((Z, cells))
+    z_sorted = np.asarray(Z)[order]
+    counts = np.bincount(cells, minlength=height * width).astype(np.int32)
+    del cells, order
+
+    # 點數超過 int32 範圍時起點改用 int64
+    starts = np.zeros(height * width, np.int32 if len(z_sorted) < 2 ** 31 else np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    occupied = np.flatnonzero(counts)
+
+    out = {}
+    for q in percentiles:
+        z = np.full(height * width, np.nan, np.float32)
+        z[occupied] = grouped_percentile(z_sorted, starts[occupied], counts[occupied], q)
+        out[q] = z.reshape(height, width)
+    return counts.reshape(height, width), out
+
+
+def build_height_grids() -> tuple:
+    """由點雲建立地面高與各 CELL_BY_CLASS 解析度的高度格網
+
+    地面高：ground_cell 格網的低百分位 Z，再以 ground_window 視窗取局部最小 (形態學侵蝕)。
+    各解析度格網：點數、最低 Z、高百分位 Z (top) 與 nDSM = top - 地面高。
+
+    Returns:
+        (ground, grids)：ground 為地面高格網，grids 以解析度為鍵
+    """
+    import cv2
+
+    X, Y, Z = pointcloud_cache["X"], pointcloud_cache["Y"], pointcloud_cache["Z"]
+    cfg = HEIGHT_GRID_CONFIG
+
+    ground = grid_geometry(X, Y, cfg["ground_cell"])
+    _, low = bin_point_grid(ground, X, Y, Z, [cfg["low_percentile"]])
+    z_ground = low[cfg["low_percentile"]]
+    k = 2 * int(round(cfg["ground_window"] / 2 / cfg["ground_cell"])) + 1
+    z_ground = cv2.erode(np.where(np.isnan(z_ground), np.inf, z_ground).astype(np.float32),
+                         np.ones((k, k), np.uint8))
+    z_ground[np.isinf(z_ground)] = np.nan
+    ground["z"] = z_ground
+
+    grids, built = {}, {}
+    for requested in sorted(set(CELL_BY_CLASS.values())):
+        # 超過格數上限時改用能放進上限的最細解析度 (原解析度的整數倍)
+        res, grid = requested, grid_geometry(X, Y, requested)
+        while grid["shape"][0] * grid["shape"][1] > cfg["max_cells"]:
+            factor = np.ceil(np.sqrt(grid["shape"][0] * grid["shape"][1] / cfg["max_cells"]))
+            res = round(float(res * max(factor, 2.0)), 6)
+            grid = grid_geometry(X, Y, res)
+        height, width = grid["shape"]
+        if res != requested:
+            print(f"[PointCloud] {requested} m grid exceeds {cfg['max_cells']} cells, using {res} m ({width}x{height} cells)")
+        if res in built:
+            grids[requested] = built[res]
+            continue
+
+        grid["count"], z = bin_point_grid(grid, X, Y, Z, [0, cfg["top_percentile"]])
+        grid["z_min"], grid["z_top"] = z[0], z[cfg["top_percentile"]]
+
+        # 每格中心對應的地面高
+        gh, gw = ground["shape"]
+        cx = grid["x0"] + (np.arange(width) + 0.5) * res
+        cy = grid["y1"] - (np.arange(height) + 0.5) * res
+        gc = np.clip(((cx - ground["x0"]) / ground["res"]).astype(np.int64), 0, gw - 1)
+        gr = np.clip(((ground["y1"] - cy) / ground["res"]).astype(np.int64), 0, gh - 1)
+        grid["ndsm"] = np.maximum(grid["z_top"] - z_ground[gr][:, gc], 0)
+        grids[requested] = built[res] = grid
+
+    return ground, grids
+
+
+def load_height_grids(key: str = None):
+    """載入或建立高度格網；點雲快取項目存在時格網一併存放，下次直接以 memmap 開啟"""
+    import json
+
+    entry = POINTCLOUD_STORE_DIR / key if key else None
+    meta_path = entry / "grids.json" if entry is not None else None
+    layers = {"ground": ["z"], "grid": ["count", "z_min", "z_top", "ndsm"]}
+
+    if meta_path is not None and meta_path.exists():
+        meta = json.loads(meta_path.read_text())
+        if (meta["config"] == HEIGHT_GRID_CONFIG and meta["resolutions"] == sorted(set(CELL_BY_CLASS.values()))
+                and all("requested" in g for g in meta["grids"])):
+            def open_grid(info, prefix, names):
+                grid = dict(info, shape=tuple(info["shape"]))
+                for name in names:
+                    grid[name] = np.load(str(entry / f"{prefix}_{name}.npy"), mmap_mode="r")
+                return grid
+
+            pointcloud_cache["ground"] = open_grid(meta["ground"], "ground", layers["ground"])
+            pointcloud_cache["grids"] = {float(g["requested"]): open_grid(g, f"grid_{g['requested']}", layers["grid"])
+                                         for g in meta["grids"]}
+            return
+
+    t0 = time.time()
+    ground, grids = build_height_grids()
+    pointcloud_cache["ground"], pointcloud_cache["grids"] = ground, grids
+    print(f"[PointCloud] Height grids {sorted(grids)} m built ({time.time() - t0:.1f}s)")
+
+    if entry is None or not entry.exists():
+        return
+    try:
+        def geometry(grid):
+            return {"res": grid["res"], "x0": grid["x0"], "y1": grid["y1"], "shape": list(grid["shape"])}
+
+        for name in layers["ground"]:
+            np.save(str(entry / f"ground_{name}.npy"), ground[name])
+        for res, grid in grids.items():
+            for name in layers["grid"]:
+                np.save(str(entry / f"grid_{res}_{name}.npy"), grid[name])
+        meta = {"config": HEIGHT_GRID_CONFIG, "resolutions": sorted(set(CELL_BY_CLASS.values())),
+                "ground": geometry(ground),
+                "grids": [dict(geometry(g), requested=res) for res, g in grids.items()]}
+        meta_path.write_text(json.dumps(meta))
+    except Exception as e:
+        print(f"[PointCloud] Failed to store height grids: {e}")
+
+
+def get_ndsm_colorized(res: float = None, max_width: int = None):
+    """取得彩色 nDSM 圖 (藍 -> 綠 -> 紅，0 - ndsm_max 公尺，無資料為黑)"""
+    grids = pointcloud_cache["grids"]
+    if not grids:
+        return None
+    grid = grids.get(res) if res else grids[min(grids)]
+    if grid is None:
+        return None
+
+    ndsm = sample_nearest(grid["ndsm"], *display_shape(*grid["ndsm"].shape, max_width))
+    idx = quantize_to_index(ndsm, 0.0, HEIGHT_GRID_CONFIG["ndsm_max"])
+    return apply_palette(idx, "ndsm")
+
+
+def close_dsm():
+    """關閉 DSM、刪除地形產品並重設 dsm_cache"""
+    if dsm_cache["src"] is not None:
+        try:
+            dsm_cache["src"].close()
+        except:
+            pass
+    remove_terrain_products()
+    dsm_cache.update({"src": None, "path": None, "transform": None, "crs": None, "loaded": False, "nodata": None, "terrain": None})
+
+
+def remove_terrain_products():
+    """刪除磁碟上的坡度/坡向檔"""
+    terrain = dsm_cache.get("terrain") or {}
+    for path in terrain.get("paths", {}).values():
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"[Terrain] Failed to delete {path}: {e}")
+
+
+def load_dsm(dsm_path):
+    """載入 DSM GeoTIFF (只開啟檔案，資料依需要以視窗讀取)"""
+    import rasterio
+    close_dsm()
+    src = rasterio.open(dsm_path)
+    with cog_lock:
+        dsm_cache["src"] = src
+        dsm_cache["path"] = str(dsm_path)
+        bump_data_version("dsm")
+    dsm_cache["transform"] = src.transform
+    dsm_cache["crs"] = src.crs
+    dsm_cache["nodata"] = src.nodata
+    dsm_cache["loaded"] = True
+    dsm_cache["resolution"] = src.res[0]  # 假設正方形像素
+    print(f"[DSM] Loaded: {src.width}x{src.height}, resolution={src.res[0]}m")
+
+
+def read_dsm_window(col: int, row: int, width: int, height: int) -> np.ndarray:
+    """讀取 DSM 視窗 (float32，nodata 轉為 NaN)"""
+    from rasterio.windows import Window
+    dem = dsm_reader().read(1, window=Window(col, row, width, height)).astype(np.float32)
+    if dsm_cache["nodata"] is not None:
+        dem[dem == np.float32(dsm_cache["nodata"])] = np.nan
+    return dem
+
+
+def compute_terrain_analysis():
+    """逐區塊計算坡度和坡向 (每個 DSM 只計算一次，結果快取於 dsm_cache["terrain"])
+
+    每個區塊連同 1 像素 halo 讀取，np.gradient 在區塊邊界得到與整張計算相同的中央差分；
+    坡度/坡向以 float32 寫入分塊 GeoTIFF，統計量 (平均、最小、最大、直方圖) 逐塊累加，
+    記憶體用量只與 block_size 有關。
+    """
+    if not dsm_cache["loaded"]:
+        return None
+    if dsm_cache["terrain"] is not None:
+        return dsm_cache["terrain"]
+
+    with terrain_lock:
+        if dsm_cache["terrain"] is None and dsm_cache["loaded"]:
+            build_terrain_products()
+    return dsm_cache["terrain"]
+
+
+def build_terrain_products():
+    """compute_terrain_analysis 的實際計算 (呼叫端持有 terrain_lock)"""
+    import rasterio
+    from rasterio.windows import Window
+
+    version = data_versions["dsm"]
+    src = dsm_reader()
+    H, W = src.height, src.width
+    res = dsm_cache["resolution"]
+    bs = TERRAIN_CONFIG["block_size"]
+    bins = TERRAIN_CONFIG["histogram_bins"]
+
+    stamp = int(time.time() * 1000)
+    paths = {name: str(TERRAIN_DIR / f"{name}_{stamp}.tif") for name in ("slope", "aspect")}
+    profile = {
+        "driver": "GTiff", "width": W, "height": H, "count": 1, "dtype": "float32",
+        "crs": src.crs, "transform": src.transform, "nodata": np.nan,
+        "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate", "BIGTIFF": "IF_SAFER",
+    }
+
+    t0 = time.time()
+    n_valid, slope_sum = 0, 0.0
+    slope_min, slope_max = np.inf, -np.inf
+    hist = np.zeros(bins, np.int64)
+
+    with rasterio.open(paths["slope"], "w", **profile) as dst_slope, \
+            rasterio.open(paths["aspect"], "w", **profile) as dst_aspect:
+        for y0 in range(0, H, bs):
+            for x0 in range(0, W, bs):
+                y1, x1 = min(y0 + bs, H), min(x0 + bs, W)
+                hy0, hx0 = max(y0 - 1, 0), max(x0 - 1, 0)
+                dem = read_dsm_window(hx0, hy0, min(x1 + 1, W) - hx0, min(y1 + 1, H) - hy0)
+
+                # 計算梯度 (使用 numpy gradient)，再裁掉 halo
+                dy, dx = np.gradient(dem, res)
+                inner = (slice(y0 - hy0, y1 - hy0), slice(x0 - hx0, x1 - hx0))
+                dy, dx = dy[inner], dx[inner]
+
+                # 坡度 (degrees)
+                slope = np.degrees(np.arctan(np.sqrt(dx ** 2 + dy ** 2)))
+
+                # 坡向 (degrees, 0=North, 90=East, 180=South, 270=West)
+                aspect = np.degrees(np.arctan2(-dx, dy))
+                aspect[aspect < 0] += 360
+
+                window = Window(x0, y0, x1 - x0, y1 - y0)
+                dst_slope.write(slope, 1, window=window)
+                dst_aspect.write(aspect, 1, window=window)
+
+                valid = slope[np.isfinite(slope)]
+                if valid.size:
+                    n_valid += valid.size
+                    slope_sum += float(valid.sum(dtype=np.float64))
+                    slope_min = min(slope_min, float(valid.min()))
+                    slope_max = max(slope_max, float(valid.max()))
+                    hist += np.histogram(valid, bins=bins, range=(0, 90))[0]
+
+    # 計算期間 DSM 已更換或清除時捨棄結果
+    if data_versions["dsm"] != version:
+        for path in paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+        return
+
+    dsm_cache["terrain"] = {
+        "paths": paths,
+        "stats": {
+            "slope_mean": slope_sum / n_valid if n_valid else float("nan"),
+            "slope_max": slope_max if n_valid else float("nan"),
+            "slope_min": slope_min if n_valid else float("nan"),
+        },
+        "histogram": {"bin_edges": np.linspace(0, 90, bins + 1).tolist(), "counts": hist.tolist()},
+    }
+    print(f"[Terrain] {W}x{H} slope/aspect computed in {time.time() - t0:.1f}s")
+
+
+def dsm_shape():
+    """DSM 大小 (高, 寬)"""
+    return dsm_cache["src"].height, dsm_cache["src"].width
+
+
+def read_terrain_layer(name: str, window=None, out_shape=None) -> np.ndarray:
+    """讀取坡度或坡向圖層 (float32)，out_shape 指定時以最近鄰降採樣讀取"""
+    import rasterio
+    with rasterio.open(dsm_cache["terrain"]["paths"][name]) as src:
+        return src.read(1, window=window, out_shape=out_shape)
+
+
+def local_slope_aspect(dem: np.ndarray, row: int, col: int, res: float):
+    """單一像素的坡度與坡向，使用與 np.gradient 相同的差分 (內部中央差分、邊界單側差分)"""
+    def diff(axis):
+        n = dem.shape[axis]
+        i = row if axis == 0 else col
+        lo, hi = max(i - 1, 0), min(i + 1, n - 1)
+        if hi == lo:
+            return 0.0
+        a = dem[lo, col] if axis == 0 else dem[row, lo]
+        b = dem[hi, col] if axis == 0 else dem[row, hi]
+        return (float(b) - float(a)) / ((hi - lo) * res)
+
+    dy, dx = diff(0), diff(1)
+    slope = np.degrees(np.arctan(np.sqrt(dx ** 2 + dy ** 2)))
+    aspect = np.degrees(np.arctan2(-dx, dy))
+    return float(slope), float(aspect + 360 if aspect < 0 else aspect)
+
+
+def get_slope_colorized(max_width: int = None):
+    """取得彩色坡度圖 (綠 -> 黃 -> 紅，0-60 度)
+
+    Args:
+        max_width: 顯示寬度；較小時直接從坡度檔讀取降採樣結果
+    """
+    if not dsm_cache["loaded"]:
+        return None
+
+    terrain = compute_terrain_analysis()
+    if terrain is None:
+        return None
+
+    slope = read_terrain_layer("slope", out_shape=display_shape(*dsm_shape(), max_width))
+    return apply_palette(quantize_to_index(slope, 0.0, 60.0), "slope")
+
+
+def get_aspect_colorized(max_width: int = None):
+    """取得彩色坡向圖 (方位角為色相)"""
+    if not dsm_cache["loaded"]:
+        return None
+
+    terrain = compute_terrain_analysis()
+    if terrain is None:
+        return None
+
+    aspect = read_terrain_layer("aspect", out_shape=display_shape(*dsm_shape(), max_width))
+    return apply_palette(quantize_to_index(aspect, 0.0, 360.0), "aspect")
+
+
+def get_terrain_at_point(x, y):
+    """取得特定座標的地形資訊"""
+    if not dsm_cache["loaded"]:
+        return {"elevation": None, "slope": None, "aspect": None}
+
+    from rasterio.windows import Window
+    transform = dsm_cache["transform"]
+    src = dsm_cache["src"]
+
+    # 座標轉換為像素
+    col = int((x - transform.c) / transform.a)
+    row = int((y - transform.f) / transform.e)
+
+    if 0 <= row < src.height and 0 <= col < src.width:
+        # 只讀取 3x3 鄰域 (影像邊界處裁切)
+        r0, c0 = max(row - 1, 0), max(col - 1, 0)
+        dem = read_dsm_window(c0, r0, min(col + 2, src.width) - c0, min(row + 2, src.height) - r0)
+        elev = float(dem[row - r0, col - c0])
+
+        # 計算局部坡度：已有地形快取時直接讀取像素，否則只用鄰近像素計算
+        if np.isfinite(elev):
+            if dsm_cache["terrain"] is not None:
+                slope = float(read_terrain_layer("slope", Window(col, row, 1, 1))[0, 0])
+                aspect = float(read_terrain_layer("aspect", Window(col, row, 1, 1))[0, 0])
+            else:
+                slope, aspect = local_slope_aspect(dem, row - r0, col - c0, dsm_cache["resolution"])
+            return {"elevation": round(elev, 2), "slope": round(slope, 1), "aspect": round(aspect, 1)}
+
+    return {"elevation": None, "slope": None, "aspect": None}
+
+
+# ============================================
+# Cloud-Optimized GeoTIFF 轉換
+# ============================================
+def needs_cog(path: str) -> bool:
+    """檔案是否缺少內部分塊或 overview"""
+    import rasterio
+    with rasterio.open(path) as src:
+        block_h, block_w = src.block_shapes[0]
+        small = max(src.width, src.height) <= COG_CONFIG["blocksize"]
+        tiled = block_w < src.width or small
+        has_overviews = bool(src.overviews(1)) or small
+    return not (tiled and has_overviews)
 
-    return colored
 
+def convert_to_cog(kind: str, path: str, version: int):
+    """將上傳的正射影像或 DSM 轉為 COG，完成後替換 ortho_cache / dsm_cache 的資料集
 
-def get_aspect_colorized():
-    """取得彩色坡向圖 (HSV colormap - direction as hue)"""
-    if not dsm_cache["loaded"]:
-        return None
+    影像大小與座標不變，因此既有快取 (有效遮罩、地形產品等) 仍然有效；
+    原檔保留到下次上傳或清除時才刪除。
 
-    terrain = compute_terrain_analysis()
-    if terrain is None:
+    Args:
+        version: 開始轉換時的 data_versions[kind]；完成時版本已變 (重新上傳或清除) 則捨棄結果
+    """
+    import rasterio
+    from rasterio.shutil import copy as rio_copy
+
+    # 每次轉換使用獨立的狀態與輸出檔，過時的轉換不會影響新的轉換
+    state = {"status": "running", "source": path, "path": None, "error": None, "seconds": None}
+    cog_state[kind] = state
+    t0 = time.time()
+    try:
+        if not needs_cog(path):
+            state.update({"status": "skipped", "seconds": round(time.time() - t0, 1)})
+            return
+
+        dst = f"{Path(path).with_suffix('')}.v{version}.cog.tif"
+        rio_copy(path, dst, driver="COG", BLOCKSIZE=COG_CONFIG["blocksize"], COMPRESS=COG_CONFIG["compress"],
+                 PREDICTOR="YES", OVERVIEW_RESAMPLING=COG_CONFIG["overview_resampling"],
+                 BIGTIFF="IF_SAFER", NUM_THREADS="ALL_CPUS")
+
+        # 轉換期間已上傳新檔 (即使同名) 或清除時捨棄結果
+        with cog_lock:
+            stale = data_versions[kind] != version
+            if not stale:
+                new_src = rasterio.open(dst)
+                if kind == "ortho":
+                    retired_datasets.append(ortho_cache["src"])
+                    ortho_cache["src"] = new_src
+                else:
+                    retired_datasets.append(dsm_cache["src"])
+                    dsm_cache["src"] = new_src
+                    dsm_cache["path"] = dst
+        if stale:
+            os.remove(dst)
+            state.update({"status": "stale"})
+            return
+        state.update({"status": "done", "path": dst, "seconds": round(time.time() - t0, 1)})
+        print(f"[COG] {kind} converted in {state['seconds']}s: {dst}")
+    except Exception as e:
+        state.update({"status": "failed", "error": str(e)})
+        print(f"[COG] {kind} conversion failed: {e}")
+
+
+def start_cog_conversion(kind: str, path: str):
+    """於背景執行緒轉換 COG"""
+    if not COG_CONFIG["enabled"]:
+        return
+    threading.Thread(target=convert_to_cog, args=(kind, path, data_versions[kind]), daemon=True).start()
+
+
+def remove_cog(kind: str):
+    """刪除轉換出的 COG 檔並重設狀態"""
+    path = cog_state[kind].get("path")
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"[COG] Failed to delete {path}: {e}")
+    cog_state[kind] = {"status": "idle"}
+
+
+def get_cog_status(kind: str) -> dict:
+    """COG 轉換狀態 (不含內部路徑)"""
+    state = cog_state[kind]
+    return {"status": state["status"], "seconds": state.get("seconds"), "error": state.get("error")}
+
+
+# ============================================
+# 圖片回應快取
+# ============================================
+_version_counter = count(1)
+_process_token = format(int(time.time() * 1000), "x")  # 區分不同行程的 ETag
+
+
+def bump_data_version(*layers):
+    """資料變更時更新版本，並移除依賴這些資料的快取圖片"""
+    for layer in layers:
+        data_versions[layer] = next(_version_counter)
+    with response_cache_lock:
+        entries = response_cache["entries"]
+        for key in [k for k, v in entries.items() if set(v["layers"]) & set(layers)]:
+            response_cache["bytes"] -= len(entries.pop(key)["content"])
+
+
+def image_cache_lookup(request: Request, name: str, layers: tuple, **params):
+    """查詢圖片快取
+
+    ETag 由端點、所依賴資料的版本與參數決定，不需產生圖片即可比對 If-None-Match。
+
+    Returns:
+        (key, response)：命中或 304 時 response 不為 None，否則呼叫端產生圖片後交給 image_cache_store
+    """
+    import hashlib
+    key = (name, tuple(data_versions[layer] for layer in layers), tuple(sorted(params.items())))
+    etag = '"' + hashlib.sha1(f"{_process_token}{key}".encode()).hexdigest()[:20] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return (key, etag, layers), Response(status_code=304, headers=headers)
+
+    with response_cache_lock:
+        entry = response_cache["entries"].get(key)
+        if entry is not None:
+            response_cache["entries"].move_to_end(key)
+    if entry is not None:
+        return (key, etag, layers), Response(content=entry["content"], media_type=entry["media_type"], headers=headers)
+    return (key, etag, layers), None
+
+
+def image_cache_store(lookup: tuple, content: bytes, media_type: str, headers: dict = None) -> Response:
+    """存入圖片快取 (超過 max_bytes / max_entries 時淘汰最久未使用者) 並回傳 Response"""
+    key, etag, layers = lookup
+    cfg = RESPONSE_CACHE_CONFIG
+    with response_cache_lock:
+        entries = response_cache["entries"]
+        # 產生期間資料已變更時不存入
+        if key[1] == tuple(data_versions[layer] for layer in layers) and len(content) <= cfg["max_bytes"]:
+            if key in entries:
+                response_cache["bytes"] -= len(entries.pop(key)["content"])
+            entries[key] = {"content": content, "media_type": media_type, "layers": layers}
+            response_cache["bytes"] += len(content)
+            while response_cache["bytes"] > cfg["max_bytes"] or len(entries) > cfg["max_entries"]:
+                _, old = entries.popitem(last=False)
+                response_cache["bytes"] -= len(old["content"])
+
+    return Response(content=content, media_type=media_type,
+                    headers={"ETag": etag, "Cache-Control": "no-cache", **(headers or {})})
+
+
+# ============================================
+# 地圖圖磚 (Web Mercator XYZ)
+# ============================================
+TILE_SIZE = 256
+TILE_LAYER_DATA = {  # 圖層 -> 依賴的資料 (用於圖片快取失效)
+    "ortho": ("ortho",),
+    "landcover": ("ortho", "landcover"),
+    "overlay": ("ortho", "landcover"),
+    "slope": ("dsm",),
+    "aspect": ("dsm",),
+    "ndsm": ("ortho", "pointcloud"),
+}
+TILE_LAYERS = tuple(TILE_LAYER_DATA)
+WEB_MERCATOR_HALF = 20037508.342789244
+
+
+def tile_transform(z: int, x: int, y: int):
+    """XYZ 圖磚的仿射轉換 (EPSG:3857)"""
+    from rasterio.transform import from_origin
+    res = 2 * WEB_MERCATOR_HALF / TILE_SIZE / 2 ** z
+    return from_origin(-WEB_MERCATOR_HALF + x * TILE_SIZE * res, WEB_MERCATOR_HALF - y * TILE_SIZE * res, res, res)
+
+
+def warp_raster_tile(path: str, indexes, transform, resampling):
+    """以 WarpedVRT 只讀取圖磚範圍所需的像素，縮小時 GDAL 會使用 overview
+
+    Returns:
+        (data, valid)：data 為 (bands, 256, 256)，valid 為有資料的像素
+    """
+    import rasterio
+    from rasterio.enums import ColorInterp, MaskFlags
+    from rasterio.vrt import WarpedVRT
+
+    with rasterio.open(path) as src:
+        # 來源已有 nodata、alpha 波段或資料集遮罩時直接沿用，否則補上 alpha 標示圖磚外範圍
+        has_mask = ColorInterp.alpha in src.colorinterp or any(
+            MaskFlags.alpha in flags or MaskFlags.per_dataset in flags for flags in src.mask_flag_enums)
+        options = {} if src.nodata is not None or has_mask else {"add_alpha": True}
+        with WarpedVRT(src, crs="EPSG:3857", transform=transform, width=TILE_SIZE, height=TILE_SIZE,
+                       resampling=resampling, **options) as vrt:
+            data = vrt.read(indexes)
+            valid = vrt.dataset_mask() > 0
+    return data, valid
+
+
+def warp_array_tile(array: np.ndarray, src_transform, src_crs, transform, nodata) -> np.ndarray:
+    """將記憶體中的 (或 memmap) 單波段陣列重投影為圖磚 (最近鄰)
+
+    只取出圖磚範圍對應的來源區塊，縮小時先以步距抽樣，不會讀取整個陣列。
+    """
+    from affine import Affine
+    from rasterio.enums import Resampling
+    from rasterio.transform import array_bounds
+    from rasterio.warp import reproject, transform_bounds
+
+    dst = np.full((TILE_SIZE, TILE_SIZE), nodata, dtype=array.dtype)
+    west, south, east, north = transform_bounds(
+        "EPSG:3857", src_crs, *array_bounds(TILE_SIZE, TILE_SIZE, transform), densify_pts=21)
+
+    inv = ~src_transform
+    cols, rows = zip(*(inv * corner for corner in ((west, north), (east, north), (west, south), (east, south))))
+    H, W = array.shape
+    c0, c1 = max(int(np.floor(min(cols))) - 1, 0), min(int(np.ceil(max(cols))) + 1, W)
+    r0, r1 = max(int(np.floor(min(rows))) - 1, 0), min(int(np.ceil(max(rows))) + 1, H)
+    if c0 >= c1 or r0 >= r1:
+        return dst
+
+    step = max(1, int((east - west) / TILE_SIZE / abs(src_transform.a)))
+    sub = np.ascontiguousarray(array[r0:r1:step, c0:c1:step])
+    sub_transform = src_transform * Affine.translation(c0, r0) * Affine.scale(step)
+    reproject(sub, dst, src_transform=sub_transform, src_crs=src_crs, dst_transform=transform,
+              dst_crs="EPSG:3857", resampling=Resampling.nearest, src_nodata=nodata, dst_nodata=nodata)
+    return dst
+
+
+def render_tile(layer: str, z: int, x: int, y: int, alpha: float = 0.5) -> np.ndarray:
+    """繪製單一 256px 圖磚 (RGBA)，只讀取該圖磚需要的資料"""
+    from rasterio.enums import Resampling
+
+    transform = tile_transform(z, x, y)
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), np.uint8)
+
+    if layer in ("ortho", "overlay"):
+        data, valid = warp_raster_tile(ortho_cache["src"].name, [1, 2, 3], transform, Resampling.bilinear)
+        rgb = ortho_to_uint8(np.moveaxis(data, 0, -1))
+        if layer == "overlay":
+            idx = warp_array_tile(landcover_cache["mask"], ortho_cache["transform"], ortho_cache["crs"],
+                                  transform, NODATA_INDEX)
+            a = alpha * (idx < UPERNET_CONFIG["num_classes"])[:, :, np.newaxis]
+            rgb = (rgb * (1 - a) + apply_palette(idx, "landcover") * a).astype(np.uint8)
+    elif layer == "landcover":
+        idx = warp_array_tile(landcover_cache["mask"], ortho_cache["transform"], ortho_cache["crs"],
+                              transform, NODATA_INDEX)
+        rgb, valid = apply_palette(idx, "landcover"), idx < UPERNET_CONFIG["num_classes"]
+    elif layer in ("slope", "aspect"):
+        data, _ = warp_raster_tile(dsm_cache["terrain"]["paths"][layer], 1, transform, Resampling.bilinear)
+        vmax = 60.0 if layer == "slope" else 360.0
+        rgb, valid = apply_palette(quantize_to_index(data, 0.0, vmax), layer), np.isfinite(data)
+    elif layer == "ndsm":
+        grids = pointcloud_cache["grids"]
+        grid = grids[min(grids)]
+        ndsm = warp_array_tile(grid["ndsm"], grid_transform(grid), ortho_cache["crs"], transform, np.nan)
+        rgb = apply_palette(quantize_to_index(ndsm, 0.0, HEIGHT_GRID_CONFIG["ndsm_max"]), "ndsm")
+        valid = np.isfinite(ndsm)
+    else:
+        raise ValueError(f"Unknown tile layer: {layer}")
+
+    rgba[:, :, :3] = rgb
+    rgba[:, :, 3] = valid * 255
+    return rgba
+
+
+# ============================================
+# 背景工作管理
+# ============================================
+class JobCancelled(Exception):
+    """工作被取消 (於切片之間的進度回報時拋出)"""
+
+
+class JobManager:
+    """背景工作佇列：固定數量的 worker 執行緒依優先權 (數字大者優先)、同優先權依送出順序取出工作
+
+    每個工作各自保存進度與結果，彼此不會覆蓋。取消排隊中的工作會直接移出佇列；
+    執行中的工作則在下一次進度回報 (每批切片之後) 時拋出 JobCancelled 結束。
+    """
+
+    def __init__(self, workers: int, max_queue: int, max_history: int):
+        import heapq
+
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.max_history = max_history
+        self.jobs = OrderedDict()
+        self._heap = []
+        self._heapq = heapq
+        self._seq = count(1)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._wait_seconds = []
+
+    def submit(self, kind: str, fn, priority: int = 0, params: dict = None) -> dict:
+        """送出工作；fn(job) 在 worker 執行緒中執行，回傳值存為工作結果"""
+        with self._cond:
+            if len(self._heap) >= self.max_queue:
+                raise HTTPException(status_code=503, detail=f"Job queue full ({self.max_queue} waiting)")
+            seq = next(self._seq)
+            job = {
+                "job_id": f"job_{int(time.time())}_{seq}", "kind": kind, "status": "pending",
+                "priority": priority, "params": params or {}, "progress": 0, "current_step": "Queued",
+                "submitted_at": time.time(), "start_time": None, "end_time": None,
+                "results": None, "error": None, "fn": fn, "cancel": threading.Event(),
+            }
+            self.jobs[job["job_id"]] = job
+            self._heapq.heappush(self._heap, (-priority, seq, job["job_id"]))
+            self._prune()
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, daemon=True, name=f"job-worker-{len(self._threads)}")
+                t.start()
+                self._threads.append(t)
+            self._cond.notify()
+        return job
+
+    def _prune(self):
+        finished = [j for j in self.jobs.values() if j["status"] in ("done", "error", "cancelled")]
+        for job in finished[:max(0, len(finished) - self.max_history)]:
+            del self.jobs[job["job_id"]]
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, job_id = self._heapq.heappop(self._heap)
+                job = self.jobs.get(job_id)
+                if job is None or job["status"] != "pending":
+                    continue
+                job["status"] = "running"
+                job["start_time"] = time.time()
+                self._wait_seconds = (self._wait_seconds + [job["start_time"] - job["submitted_at"]])[-100:]
+
+            try:
+                job["results"] = job["fn"](job)
+                job["status"] = "done"
+                job["progress"] = 100
+                job["current_step"] = "Complete"
+            except JobCancelled:
+                job["status"] = "cancelled"
+                job["current_step"] = "Cancelled"
+                print(f"[Jobs] {job_id} cancelled")
+            except Exception as e:
+                job["status"] = "error"
+                job["error"] = job["current_step"] = str(e)
+                import traceback
+                traceback.print_exc()
+            finally:
+                job["end_time"] = time.time()
+                job["fn"] = None
+
+    def update(self, job: dict, progress: int, step: str):
+        """更新進度；工作已被要求取消時拋出 JobCancelled"""
+        if job["cancel"].is_set():
+            raise JobCancelled()
+        job["progress"] = progress
+        job["current_step"] = step
+
+    def cancel(self, job_id: str) -> dict:
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] == "pending":
+                job.update({"status": "cancelled", "current_step": "Cancelled", "end_time": time.time(), "fn": None})
+                self._heap = [item for item in self._heap if item[2] != job_id]
+                self._heapq.heapify(self._heap)
+            elif job["status"] == "running":
+                job["cancel"].set()
+                job["current_step"] = "Cancelling..."
+        return job
+
+    def clear(self):
+        """取消所有工作並清除紀錄"""
+        with self._cond:
+            for job in self.jobs.values():
+                job["cancel"].set()
+            self._heap = []
+            self.jobs.clear()
+
+    def get(self, job_id: str) -> dict:
+        return self.jobs.get(job_id)
+
+    def latest(self, kind: str, status: str = None) -> dict:
+        """最近送出的指定類型工作 (可限定狀態)"""
+        for job in reversed(list(self.jobs.values())):
+            if job["kind"] == kind and (status is None or job["status"] == status):
+                return job
         return None
 
-    aspect = terrain["aspect"]
+    def queue_position(self, job: dict) -> int:
+        if job["status"] != "pending":
+            return 0
+        with self._cond:
+            ahead = sorted(self._heap)
+        return next((i for i, item in enumerate(ahead, 1) if item[2] == job["job_id"]), 0)
+
+    def public(self, job: dict) -> dict:
+        """工作狀態 (不含結果與內部欄位)"""
+        now = time.time()
+        start = job["start_time"]
+        return {
+            "job_id": job["job_id"],
+            "kind": job["kind"],
+            "status": job["status"],
+            "priority": job["priority"],
+            "progress": job["progress"],
+            "current_step": job["current_step"],
+            "queue_position": self.queue_position(job),
+            "wait_seconds": round((start or job["end_time"] or now) - job["submitted_at"], 2),
+            "elapsed_seconds": round((job["end_time"] or now) - start, 2) if start else 0,
+            "error": job["error"],
+            "params": job["params"],
+        }
+
+    def stats(self) -> dict:
+        """佇列長度、執行中工作數與等待時間"""
+        with self._cond:
+            pending = [self.jobs[item[2]] for item in self._heap if item[2] in self.jobs]
+            waits = list(self._wait_seconds)
+        now = time.time()
+        return {
+            "workers": self.workers,
+            "queued": len(pending),
+            "running": sum(1 for j in list(self.jobs.values()) if j["status"] == "running"),
+            "oldest_wait_seconds": round(max((now - j["submitted_at"] for j in pending), default=0), 2),
+            "avg_wait_seconds": round(sum(waits) / len(waits), 2) if waits else 0,
+        }
+
 
-    # Convert aspect to hue (0-360 -> 0-1)
-    hue = aspect / 360.0
+job_manager = JobManager(JOB_CONFIG["workers"], JOB_CONFIG["max_queue"], JOB_CONFIG["max_history"])
+landcover_lock = threading.Lock()  # 土地覆蓋結果為全域快取，同時只允許一個分割執行
 
-    # Create HSV image (full saturation and value)
-    H, W = aspect.shape
-    import colorsys
 
-    colored = np.zeros((H, W, 3), dtype=np.uint8)
-    for i in range(H):
-        for j in range(W):
-            if np.isnan(aspect[i, j]):
-                colored[i, j] = [0, 0, 0]
-            else:
-                r, g, b = colorsys.hsv_to_rgb(hue[i, j], 0.8, 0.9)
-                colored[i, j] = [int(r * 255), int(g * 255), int(b * 255)]
+# ============================================
+# 計算執行緒池
+# ============================================
+def get_compute_group(name: str) -> dict:
+    """取得端點群組的 semaphore 與統計 (只在事件迴圈中存取)"""
+    import asyncio
+    group = compute_state["groups"].get(name)
+    if group is None:
+        limit = COMPUTE_CONFIG["limits"].get(name, 1)
+        group = {"semaphore": asyncio.Semaphore(limit), "limit": limit, "running": 0, "waiting": 0,
+                 "completed": 0, "rejected": 0, "wait_seconds": 0.0, "run_seconds": 0.0}
+        compute_state["groups"][name] = group
+    return group
+
+
+async def run_compute(group_name: str, fn, *args):
+    """在計算執行緒池中執行 fn(*args)
+
+    同一群組同時最多執行 limit 個，其餘在 semaphore 上依序等待；排隊超過 max_waiting 時回 503，
+    避免大量圖片請求佔滿執行緒而拖慢狀態查詢等輕量端點。
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    if compute_state["executor"] is None:
+        compute_state["executor"] = ThreadPoolExecutor(max_workers=COMPUTE_CONFIG["workers"],
+                                                       thread_name_prefix="compute")
+    group = get_compute_group(group_name)
+    if group["waiting"] >= COMPUTE_CONFIG["max_waiting"]:
+        group["rejected"] += 1
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+
+    t0 = time.time()
+    group["waiting"] += 1
+    try:
+        await group["semaphore"].acquire()
+    finally:
+        group["waiting"] -= 1
+    t1 = time.time()
+    group["wait_seconds"] += t1 - t0
+    group["running"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(compute_state["executor"], fn, *args)
+    finally:
+        group["running"] -= 1
+        group["completed"] += 1
+        group["run_seconds"] += time.time() - t1
+        group["semaphore"].release()
+
+
+def get_compute_status() -> dict:
+    """各群組執行/排隊數與平均等待時間"""
+    groups = {}
+    for name, g in compute_state["groups"].items():
+        n = max(g["completed"], 1)
+        groups[name] = {
+            "limit": g["limit"], "running": g["running"], "waiting": g["waiting"],
+            "completed": g["completed"], "rejected": g["rejected"],
+            "avg_wait_seconds": round(g["wait_seconds"] / n, 3),
+            "avg_run_seconds": round(g["run_seconds"] / n, 3),
+        }
+    return {"workers": COMPUTE_CONFIG["workers"], "groups": groups}
 
-    return colored
 
+# ============================================
+# 上傳串流與背景匯入
+# ============================================
+async def receive_upload(file: UploadFile, kind: str, file_path: Path) -> dict:
+    """將上傳內容寫入 file_path.part，同時計算 SHA-256，不阻塞事件迴圈
 
-def get_terrain_at_point(x, y):
-    """取得特定座標的地形資訊"""
-    if not dsm_cache["loaded"]:
-        return {"elevation": None, "slope": None, "aspect": None}
+    Starlette 已將 multipart 內容暫存於 file.file (超過記憶體門檻時為無名暫存檔，無法直接改名)，
+    這裡於單一執行緒內分塊讀出、寫入並雜湊；回傳的匯入狀態會放入 ingest_state[kind]。
+    """
+    import asyncio
+    import hashlib
 
-    transform = dsm_cache["transform"]
-    dem = dsm_cache["data"]
+    state = {
+        "type": kind, "filename": file.filename, "status": "uploading", "step": "Receiving",
+        "bytes": 0, "sha256": None, "start_time": time.time(), "result": None, "error": None,
+    }
+    ingest_state[kind] = state
+    part_path = file_path.with_name(file_path.name + ".part")
+    h = hashlib.sha256()
+
+    def copy():
+        file.file.seek(0)
+        with open(part_path, "wb") as f:
+            while chunk := file.file.read(UPLOAD_CONFIG["chunk_size"]):
+                f.write(chunk)
+                h.update(chunk)
+                state["bytes"] += len(chunk)
 
-    # 座標轉換為像素
-    col = int((x - transform.c) / transform.a)
-    row = int((y - transform.f) / transform.e)
+    try:
+        await asyncio.to_thread(copy)
+    except Exception as e:
+        state.update({"status": "error", "error": str(e)})
+        if part_path.exists():
+            part_path.unlink()
+        raise
 
-    if 0 <= row < dem.shape[0] and 0 <= col < dem.shape[1]:
-        elev = float(dem[row, col])
-        if dsm_cache["nodata"] is not None and elev == dsm_cache["nodata"]:
-            elev = None
+    state.update({"sha256": h.hexdigest(), "status": "queued", "step": "Waiting for ingest"})
+    state["part_path"] = str(part_path)
+    print(f"[Upload] Received {file.filename}: {state['bytes'] / 1024 ** 2:.1f} MB")
+    return state
 
-        # 計算局部坡度
-        terrain = compute_terrain_analysis()
-        if terrain and elev is not None:
-            slope = float(terrain["slope"][row, col])
-            aspect = float(terrain["aspect"][row, col])
-            return {"elevation": round(elev, 2), "slope": round(slope, 1), "aspect": round(aspect, 1)}
 
-    return {"elevation": None, "slope": None, "aspect": None}
+def submit_ingest(state: dict, fn):
+    """將匯入工作交給背景執行緒 (一次一個，依上傳順序執行)，回傳 concurrent.futures.Future"""
+    global ingest_executor
+    from concurrent.futures import ThreadPoolExecutor
+
+    if ingest_executor is None:
+        ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+
+    def run():
+        state.update({"status": "running", "ingest_start": time.time()})
+        try:
+            state["result"] = fn(state)
+            state.update({"status": "done", "step": "Complete"})
+            return state["result"]
+        except Exception as e:
+            state.update({"status": "error", "error": str(e)})
+            part_path = state.get("part_path")
+            if part_path and os.path.exists(part_path):
+                os.remove(part_path)
+            import traceback
+            traceback.print_exc()
+            raise
+        finally:
+            state["end_time"] = time.time()
+
+    return ingest_executor.submit(run)
+
+
+def replace_upload(kind: str, state: dict, file_path: Path):
+    """刪除同類型的舊檔案，並將接收完成的 .part 檔移至正式路徑"""
+    old_path = uploaded_files.get(kind)
+    if old_path and os.path.exists(old_path) and old_path != str(file_path):
+        try:
+            os.remove(old_path)
+            print(f"[Upload] Deleted old {kind}: {old_path}")
+        except:
+            pass
+    os.replace(state.pop("part_path"), file_path)
+
+
+def get_ingest_status(kind: str) -> dict:
+    """匯入狀態 (不含內部欄位)"""
+    state = ingest_state.get(kind)
+    if state is None:
+        return {"type": kind, "status": "idle"}
+    end = state.get("end_time") or time.time()
+    return convert_numpy({
+        "type": kind,
+        "filename": state["filename"],
+        "status": state["status"],
+        "step": state["step"],
+        "bytes": state["bytes"],
+        "sha256": state["sha256"],
+        "elapsed_seconds": round(end - state["start_time"], 2),
+        "ingest_seconds": round(end - state["ingest_start"], 2) if state.get("ingest_start") else None,
+        "result": state["result"],
+        "error": state["error"],
+    })
+
+
+async def finish_upload(state: dict, future, background: bool) -> dict:
+    """background 時立即回傳匯入狀態，否則等待匯入完成 (不阻塞事件迴圈) 並回傳結果"""
+    import asyncio
+
+    if background:
+        return {"filename": state["filename"], "message": "Upload received, ingest queued",
+                "type": state["type"], "ingest": get_ingest_status(state["type"])}
+    try:
+        return await asyncio.wrap_future(future)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 # ============================================
@@ -795,7 +3034,8 @@ def convert_numpy(obj):
 
 @app.get("/api/detections/{project_id}")
 async def get_detections(project_id: str):
-    return convert_numpy(processing_state["results"] or [])
+    job = job_manager.latest("process", status="done")
+    return convert_numpy(job["results"] if job else [])
 
 
 @app.get("/api/gpu/status")
@@ -815,7 +3055,7 @@ async def get_ortho_bounds():
 
 
 @app.get("/api/ortho/image")
-async def get_ortho_image(max_width: int = None, quality: int = 85):
+async def get_ortho_image(request: Request, max_width: int = None, quality: int = 85):
     """取得正射影像 (JPEG with compression)
 
     Args:
@@ -825,58 +3065,62 @@ async def get_ortho_image(max_width: int = None, quality: int = 85):
     if ortho_cache["src"] is None:
         raise HTTPException(status_code=404, detail="No image loaded")
 
-    from PIL import Image
-    src = ortho_cache["src"]
-    data = src.read([1, 2, 3])
-    data = np.moveaxis(data, 0, -1)
-    if data.dtype != np.uint8:
-        data = ((data - data.min()) / (data.max() - data.min() + 1e-6) * 255).astype(np.uint8)
-
-    img = Image.fromarray(data)
-
-    # Resize if max_width specified
-    if max_width and img.width > max_width:
-        ratio = max_width / img.width
-        new_height = int(img.height * ratio)
-        img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-
-    # Use JPEG with compression for photos
-    buffer = io.BytesIO()
-    img.save(buffer, format="JPEG", quality=min(95, max(1, quality)), optimize=True)
-    buffer.seek(0)
-
-    return Response(
-        content=buffer.getvalue(),
-        media_type="image/jpeg",
-        headers={"Cache-Control": "public, max-age=3600"}
-    )
+    cached, response = image_cache_lookup(request, "ortho/image", ("ortho",), max_width=max_width, quality=quality)
+    if response is not None:
+        return response
+
+    def render():
+        from PIL import Image
+        src = ortho_cache["src"]
+        data = read_ortho_rgb(display_shape(src.height, src.width, max_width))
+        data = ortho_to_uint8(data)
+
+        img = Image.fromarray(data)
+
+        # Resize if max_width specified
+        if max_width and img.width > max_width:
+            ratio = max_width / img.width
+            new_height = int(img.height * ratio)
+            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+
+        # Use JPEG with compression for photos
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=min(95, max(1, quality)), optimize=True)
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/jpeg")
+
+    return await run_compute("image", render)
 
 
 @app.get("/api/ortho/preview")
-async def get_ortho_preview(width: int = 800, height: int = 600, quality: int = 85):
+async def get_ortho_preview(request: Request, width: int = 800, height: int = 600, quality: int = 85):
     """取得正射影像預覽 (JPEG with compression)"""
     if ortho_cache["src"] is None:
         raise HTTPException(status_code=404, detail="No image loaded")
 
-    from PIL import Image
-    src = ortho_cache["src"]
-    data = src.read([1, 2, 3])
-    data = np.moveaxis(data, 0, -1)
-    if data.dtype != np.uint8:
-        data = ((data - data.min()) / (data.max() - data.min() + 1e-6) * 255).astype(np.uint8)
-
-    img = Image.fromarray(data)
-    img.thumbnail((width, height), Image.Resampling.LANCZOS)
-
-    buffer = io.BytesIO()
-    img.save(buffer, format="JPEG", quality=min(95, max(1, quality)), optimize=True)
-    buffer.seek(0)
-
-    return Response(
-        content=buffer.getvalue(),
-        media_type="image/jpeg",
-        headers={"Cache-Control": "public, max-age=3600"}
-    )
+    cached, response = image_cache_lookup(request, "ortho/preview", ("ortho",), width=width, height=height, quality=quality)
+    if response is not None:
+        return response
+
+    def render():
+        from PIL import Image
+        src = ortho_cache["src"]
+        # 以約 2 倍預覽大小降採樣讀取，再由 LANCZOS 縮至最終大小
+        scale = min(1.0, 2 * width / src.width, 2 * height / src.height)
+        data = read_ortho_rgb((max(1, int(src.height * scale)), max(1, int(src.width * scale))))
+        data = ortho_to_uint8(data)
+
+        img = Image.fromarray(data)
+        img.thumbnail((width, height), Image.Resampling.LANCZOS)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=min(95, max(1, quality)), optimize=True)
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/jpeg")
+
+    return await run_compute("image", render)
 
 
 @app.get("/api/ortho/metadata")
@@ -892,81 +3136,130 @@ async def get_ortho_metadata():
         "crs": str(src.crs) if src.crs else None,
         "pixel_w": ortho_cache["pixel_w"],  # Resolution in meters
         "pixel_h": ortho_cache["pixel_h"],  # Resolution in meters
+        "cog": get_cog_status("ortho"),
+        "stretch": {k: ortho_cache["radiometry"][k] for k in ("dtype", "low", "high", "percentiles")}
+        if ortho_cache["radiometry"] else None,
     }
 
 
+@app.get("/api/ortho/stats")
+async def get_ortho_stats():
+    """取得正射影像輻射統計 (各 band 直方圖與百分位拉伸參數)"""
+    if ortho_cache["src"] is None:
+        raise HTTPException(status_code=404, detail="No image loaded")
+    return get_ortho_radiometry()
+
+
 @app.post("/api/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), background: bool = False):
+    """上傳正射影像 (TIFF) 或點雲 (LAZ/LAS)
+
+    內容以非同步分塊寫入並計算 SHA-256，載入交給背景匯入執行緒。
+
+    Args:
+        background: True 時接收完成即回傳，匯入進度由 /api/ingest/status 查詢
+    """
     filename = file.filename.lower()
     file_path = UPLOAD_DIR / file.filename
 
     if filename.endswith((".tif", ".tiff")):
-        # 上傳新的 ortho 時，清除所有舊資料
-        cleanup_all()
-
-    # 刪除同類型的舊檔案
-    if filename.endswith((".tif", ".tiff")) and uploaded_files.get("ortho"):
-        old_path = uploaded_files["ortho"]
-        if old_path and os.path.exists(old_path) and old_path != str(file_path):
-            try:
-                os.remove(old_path)
-                print(f"[Upload] Deleted old ortho: {old_path}")
-            except:
-                pass
-    elif filename.endswith((".laz", ".las")) and uploaded_files.get("laz"):
-        old_path = uploaded_files["laz"]
-        if old_path and os.path.exists(old_path) and old_path != str(file_path):
-            try:
-                os.remove(old_path)
-                print(f"[Upload] Deleted old laz: {old_path}")
-            except:
-                pass
+        kind = "ortho"
+    elif filename.endswith((".laz", ".las")):
+        kind = "laz"
+    else:
+        kind = "unknown"
 
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    state = await receive_upload(file, kind, file_path)
 
-    if filename.endswith((".tif", ".tiff")):
+    def ingest_ortho(state):
+        # 上傳新的 ortho 時，清除所有舊資料 (已上傳的點雲檔保留，稍後依新影像範圍重新裁切)
+        state["step"] = "Clearing previous data"
+        cleanup_all(keep=("laz",))
+        os.replace(state.pop("part_path"), file_path)
         uploaded_files["ortho"] = str(file_path)
+        state["step"] = "Loading image"
         load_ortho_image(str(file_path))
+        start_cog_conversion("ortho", str(file_path))
+        # 點雲依正射影像範圍裁切，換影像後重新載入
+        if uploaded_files.get("laz") and os.path.exists(uploaded_files["laz"]):
+            state["step"] = "Reloading point cloud"
+            laz_state = ingest_state.get("laz") or {}
+            load_point_cloud(uploaded_files["laz"], content_hash=laz_state.get("sha256")
+                             if laz_state.get("status") == "done" else None)
         return {"filename": file.filename, "message": "Image uploaded", "type": "ortho"}
-    elif filename.endswith((".laz", ".las")):
+
+    def ingest_laz(state):
+        replace_upload("laz", state, file_path)
         uploaded_files["laz"] = str(file_path)
-        load_point_cloud(str(file_path))
-        return {"filename": file.filename, "message": "Point cloud uploaded", "type": "laz", "points": len(pointcloud_cache["Z"])}
-    return {"filename": file.filename, "message": "File uploaded", "type": "unknown"}
+        state["step"] = "Loading point cloud"
+        load_point_cloud(str(file_path), content_hash=state["sha256"])
+        stats = pointcloud_cache["stats"]
+        return {"filename": file.filename, "message": "Point cloud uploaded", "type": "laz",
+                "points": stats["points_kept"], "points_dropped": stats["points_dropped"],
+                "memory_mb": stats["memory_mb"]}
+
+    def ingest_unknown(state):
+        os.replace(state.pop("part_path"), file_path)
+        return {"filename": file.filename, "message": "File uploaded", "type": "unknown"}
+
+    fn = {"ortho": ingest_ortho, "laz": ingest_laz, "unknown": ingest_unknown}[kind]
+    return await finish_upload(state, submit_ingest(state, fn), background)
 
 
 @app.post("/api/upload/dsm")
-async def upload_dsm(file: UploadFile = File(...)):
-    """上傳 DSM GeoTIFF 用於地形分析"""
+async def upload_dsm(file: UploadFile = File(...), background: bool = False):
+    """上傳 DSM GeoTIFF 用於地形分析
+
+    Args:
+        background: True 時接收完成即回傳，匯入進度由 /api/ingest/status 查詢
+    """
     filename = file.filename.lower()
     file_path = UPLOAD_DIR / file.filename
 
-    # 刪除舊的 DSM 檔案
-    if uploaded_files.get("dsm"):
-        old_path = uploaded_files["dsm"]
-        if old_path and os.path.exists(old_path) and old_path != str(file_path):
-            try:
-                os.remove(old_path)
-                print(f"[Upload] Deleted old DSM: {old_path}")
-            except:
-                pass
-        # 重設 DSM 快取
-        dsm_cache.update({"data": None, "transform": None, "crs": None, "loaded": False, "nodata": None})
+    if not filename.endswith((".tif", ".tiff")):
+        raise HTTPException(status_code=400, detail="DSM must be a GeoTIFF file")
 
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    state = await receive_upload(file, "dsm", file_path)
 
-    if filename.endswith((".tif", ".tiff")):
+    def ingest_dsm(state):
+        # 刪除舊的 DSM 檔案並重設 DSM 快取
+        if uploaded_files.get("dsm"):
+            close_dsm()
+            remove_cog("dsm")
+        replace_upload("dsm", state, file_path)
         uploaded_files["dsm"] = str(file_path)
+        state["step"] = "Loading DSM"
         load_dsm(str(file_path))
+        start_cog_conversion("dsm", str(file_path))
         return {
             "filename": file.filename,
             "message": "DSM uploaded",
             "type": "dsm",
             "resolution": dsm_cache.get("resolution"),
         }
-    raise HTTPException(status_code=400, detail="DSM must be a GeoTIFF file")
+
+    return await finish_upload(state, submit_ingest(state, ingest_dsm), background)
+
+
+@app.get("/api/ingest/status")
+async def get_ingest_status_api(type: str = None):
+    """取得上傳接收與背景匯入狀態
+
+    Args:
+        type: ortho、laz 或 dsm；未指定時回傳全部
+    """
+    if type:
+        return get_ingest_status(type)
+    return {kind: get_ingest_status(kind) for kind in ("ortho", "laz", "dsm")}
+
+
+def get_request_classes(request: ProcessingRequest) -> list[str]:
+    """依請求選項取得要偵測的 YOLO 類別"""
+    classes = []
+    if request.detect_vehicle: classes.append("car")
+    if request.detect_person: classes.append("person")
+    if request.detect_cone: classes.append("cone")
+    return classes
 
 
 @app.post("/api/process")
@@ -977,88 +3270,142 @@ async def start_processing(request: ProcessingRequest = None):
     if ortho_cache["src"] is None:
         raise HTTPException(status_code=400, detail="Please upload an image first")
 
-    job_id = f"job_{int(time.time())}"
-    processing_state["job_id"] = job_id
-    processing_state["status"] = "pending"
-    processing_state["progress"] = 0
-    processing_state["start_time"] = time.time()
-    processing_state["results"] = []
+    try:
+        plan = await run_compute("image", plan_tiling, get_request_classes(request), request.tiling_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def run(job):
+        classes = get_request_classes(request)
+
+        def update_progress(progress, step):
+            job_manager.update(job, progress, step)
+
+        # YOLO detection (0-70%)
+        update_progress(10, "Loading models...")
+        detections = run_yolo_detection(classes, update_progress, batch_size=request.batch_size,
+                                        tiling_mode=request.tiling_mode, workers=request.parallel_workers)
+
+        # Height analysis (70-80%)
+        if request.include_elevation:
+            update_progress(70, "Height analysis...")
+            detections = compute_height_volume(detections, update_progress)
+
+        # Landcover segmentation (80-95%)
+        if request.include_landcover:
+            update_progress(80, "Loading UPerNet model...")
+            def landcover_progress(p, step):
+                update_progress(80 + int(p * 0.15), step)
+            with landcover_lock:
+                run_landcover_segmentation(landcover_progress, workers=request.parallel_workers,
+                                           gsd=request.landcover_gsd or None)
+
+        update_progress(95, "Coordinate transform...")
+        detections = add_latlon_to_detections(detections)
+
+        for i, det in enumerate(detections, 1):
+            det["id"] = i
+            det.pop("px1", None)
+            det.pop("py1", None)
+            det.pop("px2", None)
+            det.pop("py2", None)
+        return detections
+
+    job = job_manager.submit("process", run, priority=request.priority,
+                             params={"classes": get_request_classes(request), "tiling_mode": request.tiling_mode,
+                                     "include_elevation": request.include_elevation,
+                                     "include_landcover": request.include_landcover})
+    return convert_numpy({"job_id": job["job_id"], "status": "started", "message": "Processing started", "plan": plan,
+                          "queue_position": job_manager.queue_position(job)})
 
-    def update_progress(progress, step):
-        processing_state["progress"] = progress
-        processing_state["current_step"] = step
-        processing_state["elapsed_seconds"] = time.time() - processing_state["start_time"]
 
-    def run():
-        try:
-            processing_state["status"] = "running"
-            classes = []
-            if request.detect_vehicle: classes.append("car")
-            if request.detect_person: classes.append("person")
-            if request.detect_cone: classes.append("cone")
-
-            # YOLO detection (0-70%)
-            update_progress(10, "Loading models...")
-            detections = run_yolo_detection(classes, update_progress)
-
-            # Height analysis (70-80%)
-            if request.include_elevation:
-                update_progress(70, "Height analysis...")
-                detections = compute_height_volume(detections, update_progress)
-
-            # Landcover segmentation (80-95%)
-            if request.include_landcover:
-                update_progress(80, "Loading UPerNet model...")
-                def landcover_progress(p, step):
-                    update_progress(80 + int(p * 0.15), step)
-                run_landcover_segmentation(landcover_progress)
-
-            update_progress(95, "Coordinate transform...")
-            detections = add_latlon_to_detections(detections)
-
-            for i, det in enumerate(detections, 1):
-                det["id"] = i
-                det.pop("px1", None)
-                det.pop("py1", None)
-                det.pop("px2", None)
-                det.pop("py2", None)
-
-            processing_state["results"] = detections
-            processing_state["status"] = "done"
-            update_progress(100, "Complete")
-        except Exception as e:
-            processing_state["status"] = "error"
-            processing_state["current_step"] = str(e)
-            import traceback
-            traceback.print_exc()
+@app.post("/api/process/plan")
+async def get_processing_plan(request: ProcessingRequest = None):
+    """預估切片數量與推論時間（不實際執行）"""
+    if request is None:
+        request = ProcessingRequest()
 
-    threading.Thread(target=run, daemon=True).start()
-    return {"job_id": job_id, "status": "started", "message": "Processing started"}
+    if ortho_cache["src"] is None:
+        raise HTTPException(status_code=400, detail="Please upload an image first")
+
+    try:
+        plan = await run_compute("image", plan_tiling, get_request_classes(request), request.tiling_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return convert_numpy(plan)
+
+
+def processing_status(job: dict) -> dict:
+    """處理工作狀態 (沿用 /api/process/status 的欄位，另含佇列資訊)"""
+    if job is None:
+        return {"job_id": None, "status": "idle", "progress": 0, "current_step": "", "elapsed_seconds": 0,
+                "prefetch": dict(prefetch_stats), "queue": job_manager.stats()}
+    info = job_manager.public(job)
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "current_step": job["current_step"],
+        "elapsed_seconds": info["elapsed_seconds"],
+        "queue_position": info["queue_position"],
+        "wait_seconds": info["wait_seconds"],
+        "prefetch": dict(prefetch_stats),
+        "queue": job_manager.stats(),
+    }
 
 
 @app.get("/api/process/status")
 async def get_current_processing_status():
-    """取得目前處理狀態（不需要 job_id）"""
-    return {
-        "job_id": processing_state["job_id"],
-        "status": processing_state["status"],
-        "progress": processing_state["progress"],
-        "current_step": processing_state["current_step"],
-        "elapsed_seconds": time.time() - processing_state["start_time"] if processing_state["start_time"] else 0,
-    }
+    """取得最近送出的處理工作狀態（不需要 job_id）"""
+    return processing_status(job_manager.latest("process"))
+
+
+@app.get("/api/compute/status")
+async def get_compute_status_api():
+    """取得計算執行緒池各端點群組的執行與排隊狀態"""
+    return get_compute_status()
 
 
 @app.get("/api/process/{job_id}/status")
 async def get_processing_status(job_id: str):
-    if processing_state["job_id"] != job_id:
+    job = job_manager.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return {
-        "job_id": job_id,
-        "status": processing_state["status"],
-        "progress": processing_state["progress"],
-        "current_step": processing_state["current_step"],
-        "elapsed_seconds": time.time() - processing_state["start_time"] if processing_state["start_time"] else 0,
-    }
+    return processing_status(job)
+
+
+# ============================================
+# 工作管理 API
+# ============================================
+@app.get("/api/jobs")
+async def list_jobs(status: str = None, kind: str = None):
+    """列出工作 (新到舊) 與佇列統計
+
+    Args:
+        status: pending、running、done、error 或 cancelled
+        kind: process 或 landcover
+    """
+    jobs = [job_manager.public(j) for j in reversed(list(job_manager.jobs.values()))
+            if (status is None or j["status"] == status) and (kind is None or j["kind"] == kind)]
+    return convert_numpy({"jobs": jobs, "queue": job_manager.stats()})
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """取得單一工作狀態與結果"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return convert_numpy({**job_manager.public(job), "results": job["results"]})
+
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """取消工作：排隊中直接移除，執行中於下一批切片完成後停止"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return convert_numpy(job_manager.public(job))
 
 
 @app.get("/api/terrain/status")
@@ -1067,6 +3414,7 @@ async def get_terrain_status():
     return {
         "dsm_loaded": dsm_cache["loaded"],
         "resolution": dsm_cache.get("resolution") if dsm_cache["loaded"] else None,
+        "cog": get_cog_status("dsm"),
     }
 
 
@@ -1076,13 +3424,14 @@ async def get_terrain_stats():
     if not dsm_cache["loaded"]:
         raise HTTPException(status_code=400, detail="No DSM loaded")
 
-    terrain = compute_terrain_analysis()
+    terrain = await run_compute("terrain", compute_terrain_analysis)
     if terrain is None:
         raise HTTPException(status_code=500, detail="Failed to compute terrain analysis")
 
     return convert_numpy({
         "resolution": dsm_cache.get("resolution"),
         "stats": terrain["stats"],
+        "histogram": terrain["histogram"],
     })
 
 
@@ -1097,68 +3446,75 @@ async def get_terrain_at_location(x: float, y: float):
 
 
 @app.get("/api/terrain/slope")
-async def get_terrain_slope_image(max_width: int = None):
+async def get_terrain_slope_image(request: Request, max_width: int = None):
     """取得坡度彩色圖 (PNG with compression)"""
     if not dsm_cache["loaded"]:
         raise HTTPException(status_code=400, detail="No DSM loaded")
 
-    from PIL import Image
-    color_img = get_slope_colorized()
-    if color_img is None:
-        raise HTTPException(status_code=500, detail="Failed to generate slope image")
+    cached, response = image_cache_lookup(request, "terrain/slope", ("dsm",), max_width=max_width)
+    if response is not None:
+        return response
 
-    img = Image.fromarray(color_img)
+    def render():
+        from PIL import Image
+        color_img = get_slope_colorized(max_width)
+        if color_img is None:
+            raise HTTPException(status_code=500, detail="Failed to generate slope image")
 
-    # Resize if max_width specified
-    if max_width and img.width > max_width:
-        ratio = max_width / img.width
-        new_height = int(img.height * ratio)
-        img = img.resize((max_width, new_height), Image.Resampling.NEAREST)
+        img = Image.fromarray(color_img)
 
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG", optimize=True)
-    buffer.seek(0)
+        # Resize if max_width specified
+        if max_width and img.width > max_width:
+            ratio = max_width / img.width
+            new_height = int(img.height * ratio)
+            img = img.resize((max_width, new_height), Image.Resampling.NEAREST)
 
-    return Response(
-        content=buffer.getvalue(),
-        media_type="image/png",
-        headers={"Cache-Control": "public, max-age=3600"}
-    )
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG", optimize=True)
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/png")
+
+    return await run_compute("image", render)
 
 
 @app.get("/api/terrain/aspect")
-async def get_terrain_aspect_image(max_width: int = None):
+async def get_terrain_aspect_image(request: Request, max_width: int = None):
     """取得坡向彩色圖 (PNG with compression)"""
     if not dsm_cache["loaded"]:
         raise HTTPException(status_code=400, detail="No DSM loaded")
 
-    from PIL import Image
-    color_img = get_aspect_colorized()
-    if color_img is None:
-        raise HTTPException(status_code=500, detail="Failed to generate aspect image")
+    cached, response = image_cache_lookup(request, "terrain/aspect", ("dsm",), max_width=max_width)
+    if response is not None:
+        return response
 
-    img = Image.fromarray(color_img)
+    def render():
+        from PIL import Image
+        color_img = get_aspect_colorized(max_width)
+        if color_img is None:
+            raise HTTPException(status_code=500, detail="Failed to generate aspect image")
 
-    # Resize if max_width specified
-    if max_width and img.width > max_width:
-        ratio = max_width / img.width
-        new_height = int(img.height * ratio)
-        img = img.resize((max_width, new_height), Image.Resampling.NEAREST)
+        img = Image.fromarray(color_img)
 
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG", optimize=True)
-    buffer.seek(0)
+        # Resize if max_width specified
+        if max_width and img.width > max_width:
+            ratio = max_width / img.width
+            new_height = int(img.height * ratio)
+            img = img.resize((max_width, new_height), Image.Resampling.NEAREST)
 
-    return Response(
-        content=buffer.getvalue(),
-        media_type="image/png",
-        headers={"Cache-Control": "public, max-age=3600"}
-    )
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG", optimize=True)
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/png")
+
+    return await run_compute("image", render)
 
 
 @app.get("/api/export/stats")
 async def export_stats():
-    results = convert_numpy(processing_state["results"])
+    job = job_manager.latest("process", status="done")
+    results = convert_numpy(job["results"] if job else [])
     stats = {
         "total": len(results),
         "person": len([r for r in results if r.get("cls") == "person"]),
@@ -1168,15 +3524,153 @@ async def export_stats():
     return {"generated_at": datetime.now().isoformat(), "summary": stats, "detections": results}
 
 
+# ============================================
+# 地圖圖磚 API
+# ============================================
+@app.get("/api/tiles/{layer}/{z}/{x}/{y}")
+async def get_map_tile(request: Request, layer: str, z: int, x: int, y: int, alpha: float = 0.5):
+    """取得 XYZ 圖磚 (256px Web Mercator PNG，無資料處透明)
+
+    Args:
+        layer: ortho, landcover, overlay, slope, aspect 或 ndsm
+        alpha: overlay 圖層的土地覆蓋透明度 (0-1)
+    """
+    if layer not in TILE_LAYERS:
+        raise HTTPException(status_code=404, detail=f"Unknown layer, available: {list(TILE_LAYERS)}")
+    if layer in ("ortho", "landcover", "overlay") and ortho_cache["src"] is None:
+        raise HTTPException(status_code=400, detail="No ortho image loaded")
+    if layer in ("landcover", "overlay") and not landcover_cache["computed"]:
+        raise HTTPException(status_code=400, detail="Landcover not computed yet")
+    if layer in ("slope", "aspect"):
+        if not dsm_cache["loaded"]:
+            raise HTTPException(status_code=400, detail="No DSM loaded")
+        await run_compute("terrain", compute_terrain_analysis)
+    if layer == "ndsm" and not pointcloud_cache["loaded"]:
+        raise HTTPException(status_code=400, detail="No point cloud loaded")
+    if layer == "ndsm" and not pointcloud_cache["grids"]:
+        raise HTTPException(status_code=400, detail="Height grids not available for this point cloud")
+    if layer == "ndsm" and ortho_cache["crs"] is None:
+        # 點雲格網以正射影像的座標系統定位
+        raise HTTPException(status_code=400, detail="No ortho image loaded")
+
+    cached, response = image_cache_lookup(request, f"tiles/{layer}", TILE_LAYER_DATA[layer], z=z, x=x, y=y, alpha=alpha)
+    if response is not None:
+        return response
+
+    def render():
+        from PIL import Image
+        img = Image.fromarray(render_tile(layer, z, x, y, alpha), mode="RGBA")
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/png")
+
+    return await run_compute("tiles", render)
+
+
+# ============================================
+# 點雲 API
+# ============================================
+@app.get("/api/pointcloud/status")
+async def get_pointcloud_status():
+    """取得點雲載入狀態與高度格網資訊"""
+    grids = []
+    for res, grid in sorted((pointcloud_cache["grids"] or {}).items()):
+        t = grid_transform(grid)
+        height, width = grid["shape"]
+        grids.append({
+            "resolution": res,
+            "actual_resolution": grid["res"],
+            "shape": grid["shape"],
+            "bounds": {"west": t.c, "north": t.f, "east": t.c + width * grid["res"], "south": t.f - height * grid["res"]},
+        })
+
+    return convert_numpy({
+        "loaded": pointcloud_cache["loaded"],
+        "stats": pointcloud_cache["stats"],
+        "grids": grids,
+    })
+
+
+@app.get("/api/pointcloud/ndsm")
+async def get_ndsm_image(request: Request, resolution: float = None, format: str = "png", max_width: int = None):
+    """取得地表以上高度 (nDSM) 圖層
+
+    Args:
+        resolution: 格網解析度 (公尺)，預設最細的 CELL_BY_CLASS 解析度
+        format: png (彩色圖) 或 tif (float32 GeoTIFF，含座標)
+        max_width: PNG 最大寬度
+    """
+    grids = pointcloud_cache["grids"]
+    if not pointcloud_cache["loaded"]:
+        raise HTTPException(status_code=400, detail="No point cloud loaded")
+    if not grids:
+        raise HTTPException(status_code=400, detail="Height grids not available for this point cloud")
+    res = resolution or min(grids)
+    if res not in grids:
+        raise HTTPException(status_code=400, detail=f"Available resolutions: {sorted(grids)}")
+    if format == "tif" and ortho_cache["crs"] is None:
+        raise HTTPException(status_code=400, detail="No ortho image loaded")
+
+    cached, response = image_cache_lookup(request, "pointcloud/ndsm", ("pointcloud",), res=res, format=format, max_width=max_width)
+    if response is not None:
+        return response
+
+    def render():
+        if format == "tif":
+            from rasterio.io import MemoryFile
+            ndsm = np.asarray(grids[res]["ndsm"], dtype=np.float32)
+            profile = {
+                "driver": "GTiff", "width": ndsm.shape[1], "height": ndsm.shape[0], "count": 1,
+                "dtype": "float32", "crs": ortho_cache["crs"], "transform": grid_transform(grids[res]),
+                "nodata": np.nan, "compress": "deflate", "tiled": True,
+            }
+            with MemoryFile() as memfile:
+                with memfile.open(**profile) as dst:
+                    dst.write(ndsm, 1)
+                content = memfile.read()
+            return image_cache_store(cached, content, "image/tiff",
+                                     {"Content-Disposition": f"attachment; filename=ndsm_{grids[res]['res']}m.tif"})
+
+        from PIL import Image
+        img = Image.fromarray(get_ndsm_colorized(res, max_width))
+
+        # Resize if max_width specified
+        if max_width and img.width > max_width:
+            ratio = max_width / img.width
+            new_height = int(img.height * ratio)
+            img = img.resize((max_width, new_height), Image.Resampling.NEAREST)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG", optimize=True)
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/png")
+
+    return await run_compute("image", render)
+
+
 # ============================================
 # 土地覆蓋 API
 # ============================================
+def get_landcover_job() -> dict:
+    """最近一次背景土地覆蓋工作的狀態"""
+    job = job_manager.latest("landcover")
+    if job is None:
+        return {"status": "idle", "progress": 0, "current_step": "", "elapsed_seconds": 0, "error": None}
+    return job_manager.public(job)
+
+
 @app.get("/api/landcover/status")
 async def get_landcover_status():
     """取得土地覆蓋偵測狀態"""
     return {
         "computed": landcover_cache["computed"],
         "has_stats": landcover_cache["stats"] is not None,
+        "resolution": landcover_cache["resolution"],
+        "job": get_landcover_job(),
     }
 
 
@@ -1194,7 +3688,7 @@ async def get_landcover_stats():
 
 
 @app.get("/api/landcover/image")
-async def get_landcover_image(max_width: int = None):
+async def get_landcover_image(request: Request, max_width: int = None):
     """取得土地覆蓋彩色圖 (PNG with compression)
 
     Args:
@@ -1203,32 +3697,35 @@ async def get_landcover_image(max_width: int = None):
     if not landcover_cache["computed"]:
         raise HTTPException(status_code=400, detail="Landcover not computed yet")
 
-    from PIL import Image
-    color_img = get_landcover_colorized()
-    if color_img is None:
-        raise HTTPException(status_code=500, detail="Failed to generate colorized landcover")
+    cached, response = image_cache_lookup(request, "landcover/image", ("landcover",), max_width=max_width)
+    if response is not None:
+        return response
 
-    img = Image.fromarray(color_img)
+    def render():
+        from PIL import Image
+        color_img = get_landcover_colorized(max_width)
+        if color_img is None:
+            raise HTTPException(status_code=500, detail="Failed to generate colorized landcover")
 
-    # Resize if max_width specified
-    if max_width and img.width > max_width:
-        ratio = max_width / img.width
-        new_height = int(img.height * ratio)
-        img = img.resize((max_width, new_height), Image.Resampling.NEAREST)  # Use NEAREST for segmentation masks
+        img = Image.fromarray(color_img)
 
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG", optimize=True)
-    buffer.seek(0)
+        # Resize if max_width specified
+        if max_width and img.width > max_width:
+            ratio = max_width / img.width
+            new_height = int(img.height * ratio)
+            img = img.resize((max_width, new_height), Image.Resampling.NEAREST)  # Use NEAREST for segmentation masks
 
-    return Response(
-        content=buffer.getvalue(),
-        media_type="image/png",
-        headers={"Cache-Control": "public, max-age=3600"}
-    )
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG", optimize=True)
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/png")
+
+    return await run_compute("image", render)
 
 
 @app.get("/api/landcover/overlay")
-async def get_landcover_overlay(alpha: float = 0.5, max_width: int = None, quality: int = 85):
+async def get_landcover_overlay(request: Request, alpha: float = 0.5, max_width: int = None, quality: int = 85):
     """取得土地覆蓋疊加圖（正射影像 + 土地覆蓋, JPEG with compression）
 
     Args:
@@ -1241,63 +3738,75 @@ async def get_landcover_overlay(alpha: float = 0.5, max_width: int = None, quali
     if ortho_cache["src"] is None:
         raise HTTPException(status_code=400, detail="No ortho image loaded")
 
-    from PIL import Image
+    cached, response = image_cache_lookup(request, "landcover/overlay", ("ortho", "landcover"), alpha=alpha, max_width=max_width, quality=quality)
+    if response is not None:
+        return response
 
-    # Get ortho image
-    src = ortho_cache["src"]
-    data = src.read([1, 2, 3])
-    ortho_img = np.moveaxis(data, 0, -1)
-    if ortho_img.dtype != np.uint8:
-        ortho_img = ((ortho_img - ortho_img.min()) / (ortho_img.max() - ortho_img.min() + 1e-6) * 255).astype(np.uint8)
+    def render():
+        from PIL import Image
 
-    # Get landcover colorized
-    color_img = get_landcover_colorized()
-    if color_img is None:
-        raise HTTPException(status_code=500, detail="Failed to generate colorized landcover")
+        # Get ortho image (降採樣讀取至顯示大小)
+        src = ortho_cache["src"]
+        out_shape = display_shape(src.height, src.width, max_width)
+        ortho_img = read_ortho_rgb(out_shape)
+        ortho_img = ortho_to_uint8(ortho_img)
 
-    # Create mask for valid landcover (not nodata)
-    mask = landcover_cache["mask"]
-    valid_mask = (mask < UPERNET_CONFIG["num_classes"]).astype(np.float32)
+        # Get landcover colorized
+        color_img = get_landcover_colorized(max_width)
+        if color_img is None:
+            raise HTTPException(status_code=500, detail="Failed to generate colorized landcover")
 
-    # Blend
-    blended = ortho_img.astype(np.float32) * (1 - alpha * valid_mask[:, :, np.newaxis]) + \
-              color_img.astype(np.float32) * alpha * valid_mask[:, :, np.newaxis]
-    blended = np.clip(blended, 0, 255).astype(np.uint8)
+        # Create mask for valid landcover (not nodata)
+        mask = sample_nearest(landcover_cache["mask"], *out_shape)
+        valid_mask = (mask < UPERNET_CONFIG["num_classes"]).astype(np.float32)
 
-    img = Image.fromarray(blended)
+        # Blend
+        blended = ortho_img.astype(np.float32) * (1 - alpha * valid_mask[:, :, np.newaxis]) + \
+                  color_img.astype(np.float32) * alpha * valid_mask[:, :, np.newaxis]
+        blended = np.clip(blended, 0, 255).astype(np.uint8)
 
-    # Resize if max_width specified
-    if max_width and img.width > max_width:
-        ratio = max_width / img.width
-        new_height = int(img.height * ratio)
-        img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+        img = Image.fromarray(blended)
 
-    buffer = io.BytesIO()
-    img.save(buffer, format="JPEG", quality=min(95, max(1, quality)), optimize=True)
-    buffer.seek(0)
+        # Resize if max_width specified
+        if max_width and img.width > max_width:
+            ratio = max_width / img.width
+            new_height = int(img.height * ratio)
+            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
 
-    return Response(
-        content=buffer.getvalue(),
-        media_type="image/jpeg",
-        headers={"Cache-Control": "public, max-age=3600"}
-    )
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=min(95, max(1, quality)), optimize=True)
+        buffer.seek(0)
+
+        return image_cache_store(cached, buffer.getvalue(), "image/jpeg")
+
+    return await run_compute("image", render)
 
 
 @app.post("/api/landcover/run")
-async def run_landcover():
-    """單獨執行土地覆蓋偵測"""
+async def run_landcover(tile_size: int = None, batch_size: int = None, gsd: float = None):
+    """於背景執行土地覆蓋偵測，進度與結果由 /api/landcover/status 查詢
+
+    Args:
+        tile_size: UPerNet 切片邊長 (預設 64，與訓練時相同)
+        batch_size: 每次推論的切片數 (預設 8)
+        gsd: 推論解析度 (公尺)，較粗的 GSD 以精度換取速度 (預設原始解析度)
+    """
     if ortho_cache["src"] is None:
         raise HTTPException(status_code=400, detail="Please upload an image first")
+    active = job_manager.latest("landcover")
+    if active is not None and active["status"] in ("pending", "running"):
+        raise HTTPException(status_code=409, detail="Landcover segmentation already running")
 
-    try:
-        result = run_landcover_segmentation()
-        return convert_numpy({
-            "status": "done",
-            "stats": result["stats"],
-            "shape": result["shape"],
-        })
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    def run(job):
+        def update_progress(progress, step):
+            job_manager.update(job, progress, step)
+
+        with landcover_lock:
+            result = run_landcover_segmentation(update_progress, tile_size=tile_size, batch_size=batch_size, gsd=gsd)
+        return {"stats": result["stats"], "skipped_tiles": result["skipped_tiles"], "resolution": result["resolution"]}
+
+    job = job_manager.submit("landcover", run, params={"tile_size": tile_size, "batch_size": batch_size, "gsd": gsd})
+    return {"status": "started", "message": "Landcover segmentation started", "job": job_manager.public(job)}
 
 
 @app.post("/api/cleanup")
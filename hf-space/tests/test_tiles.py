@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import app  # noqa: E402
+
+Z, X, Y = 18, 219512, 112310
+
+
+def write_ortho(path, count, alpha=None):
+    """寫出涵蓋圖磚左半部的 EPSG:3857 正射影像 (128x256)"""
+    t = app.tile_transform(Z, X, Y)
+    data = np.full((count, 256, 128), 200, np.uint8)
+    if alpha is not None:
+        data[3] = alpha
+    profile = {"driver": "GTiff", "width": 128, "height": 256, "count": count, "dtype": "uint8",
+               "crs": "EPSG:3857", "transform": t}
+    if count == 4:
+        profile["photometric"] = "RGB"
+        profile["alpha"] = "YES"
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+
+
+def test_ortho_tile_rgba_source(tmp_path):
+    alpha = np.full((256, 128), 255, np.uint8)
+    alpha[:128] = 0
+    write_ortho(tmp_path / "rgba.tif", 4, alpha)
+    app.load_ortho_image(str(tmp_path / "rgba.tif"))
+
+    rgba = app.render_tile("ortho", Z, X, Y)
+    assert rgba.shape == (256, 256, 4)
+    assert (rgba[:120, :120, 3] == 0).all()
+    assert (rgba[136:, :120, 3] == 255).all()
+    assert (rgba[:, 136:, 3] == 0).all()
+
+
+def test_ortho_tile_rgb_source_without_nodata(tmp_path):
+    write_ortho(tmp_path / "rgb.tif", 3)
+    app.load_ortho_image(str(tmp_path / "rgb.tif"))
+
+    rgba = app.render_tile("ortho", Z, X, Y)
+    assert (rgba[:, :120, 3] == 255).all()
+    assert (rgba[:, 136:, 3] == 0).all()